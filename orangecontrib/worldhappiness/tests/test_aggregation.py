@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+
+from orangecontrib.worldhappiness.whstudy import AggregationMethods, YearStatistics
+
+
+def no_callback(*_):
+    pass
+
+
+class TestStatistics(unittest.TestCase):
+    def setUp(self):
+        self.countries = ["C1", "C2", "NODATA"]
+        self.names = np.array(["Country 1", "Country 2", "No data"], dtype=object)
+        self.cols = [f"{y}-{code}" for code in ("A", "EMPTY") for y in (2010, 2011, 2012)]
+        self.values = np.array([[1, 2, 3, np.nan, np.nan, np.nan],
+                                [4, np.nan, 6, np.nan, np.nan, np.nan],
+                                [np.nan] * 6])
+
+    def aggregate(self, statistics, freq=1):
+        return AggregationMethods.aggregate_values(self.countries, self.names, self.cols, self.values,
+                                                   AggregationMethods.STATISTICS, no_callback, freq, freq,
+                                                   statistics)
+
+    def test_statistics(self):
+        table = self.aggregate([YearStatistics.COUNT, YearStatistics.LATEST, YearStatistics.TREND])
+        self.assertEqual([a.name for a in table.domain.attributes], ["A - Count", "A - Latest", "A - Trend"])
+        np.testing.assert_equal(table.X, [[3, 3, 1], [2, 6, 1]])
+
+    def test_all_statistics(self):
+        table = self.aggregate(None)
+        self.assertEqual([a.name for a in table.domain.attributes],
+                         [f"A - {item}" for item in YearStatistics.ITEMS])
+
+    def test_no_statistics(self):
+        table = self.aggregate([], freq=0)
+        self.assertEqual(len(table.domain.attributes), 0)
+
+    def test_zero_counts_are_missing(self):
+        # Indicator and country without values are dropped even with counts of zero
+        table = self.aggregate([YearStatistics.COUNT], freq=0)
+        self.assertEqual([a.name for a in table.domain.attributes], ["A - Count"])
+        self.assertEqual(list(table.metas[:, 0]), ["C1", "C2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import asyncio
+import unittest
+
+from orangecontrib.worldhappiness.whstudy import async_world_data_api
+from orangecontrib.worldhappiness.whstudy.async_world_data_api import AsyncWorldIndicators
+from orangecontrib.worldhappiness.whstudy.world_data_api import WorldIndicators
+
+LOCAL_URI = "mongodb://localhost:27017"
+TEST_DB_NAME = "world-database-test"
+
+COUNTRIES = [
+    {"_id": "SVN", "name": "Slovenia", "indicators": {"A_B": {"2010": 1.0, "2011": 2.0}, "C_D": {"2005": 3.0}}},
+    {"_id": "AUT", "name": "Austria", "indicators": {"A_B": {"2011": 4.0}}},
+    {"_id": "HRV", "name": "Croatia", "indicators": {"A_B": {"2010": 5.0}, "C_D": {"2010": 6.0}}},
+]
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ChunkIndicators(AsyncWorldIndicators):
+    """ Serves the first chunk at once and keeps the other ones running. """
+
+    def __init__(self):
+        super().__init__("user", "password")
+        self.cancelled = []
+
+    def get_connection(self):
+        return None
+
+    async def find_countries(self, countries, projection, semaphore):
+        if countries == ["SVN"]:
+            return [{"_id": "SVN", "name": "Slovenia", "values": {}, "last": {}}]
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            self.cancelled.extend(countries)
+            raise
+        return []
+
+
+@unittest.skipIf(async_world_data_api.AsyncMongoClient is None, "AsyncMongoClient requires pymongo>=4.10")
+class TestAsyncWorldIndicators(unittest.TestCase):
+    def test_interrupted_query_cancels_chunks(self):
+        handle = ChunkIndicators()
+
+        def callback(progress, status=""):
+            if progress > 0:
+                raise Interrupted
+
+        async def query():
+            with self.assertRaises(Interrupted):
+                await handle.data(["SVN", "AUT", "HRV"], ["A.B"], [2010], callback=callback, batch_size=1)
+            # No chunk is left running after the query
+            current = asyncio.current_task()
+            self.assertEqual([t for t in asyncio.all_tasks() if t is not current], [])
+
+        asyncio.run(query())
+        self.assertEqual(sorted(handle.cancelled), ["AUT", "HRV"])
+
+
+@unittest.skipIf(async_world_data_api.AsyncMongoClient is None, "AsyncMongoClient requires pymongo>=4.10")
+class TestLocalMongod(unittest.TestCase):
+    """ Compares the asyncio backend with WorldIndicators on a local mongod. """
+
+    @classmethod
+    def setUpClass(cls):
+        from pymongo import MongoClient
+        from pymongo.errors import PyMongoError
+
+        cls.client = MongoClient(LOCAL_URI, serverSelectionTimeoutMS=500)
+        try:
+            cls.client.admin.command("ping")
+        except PyMongoError:
+            cls.client.close()
+            raise unittest.SkipTest("local mongod is not running")
+        db = cls.client[TEST_DB_NAME]
+        db.countries.drop()
+        db.countries.insert_many(COUNTRIES)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.drop_database(TEST_DB_NAME)
+        cls.client.close()
+
+    def test_data_equals_blocking_backend(self):
+        class Local(AsyncWorldIndicators):
+            def get_connection(self):
+                return async_world_data_api.AsyncMongoClient(LOCAL_URI)[TEST_DB_NAME]
+
+        class Blocking(WorldIndicators):
+            def get_connection(self):
+                return self.client[TEST_DB_NAME]
+
+        blocking = Blocking("user", "password", disk_cache=False)
+        blocking.client = self.client
+        countries = ["SVN", "AUT", "HRV", "XXX"]
+        for year in ([2010], [2010, 2011]):
+            expected = blocking.data(countries, ["A.B", "C.D"], year)
+            result = asyncio.run(Local("user", "password", max_concurrency=2).data(
+                countries, ["A.B", "C.D"], year, batch_size=1))
+            self.assertTrue(result.equals(expected), year)
+
+
+if __name__ == "__main__":
+    unittest.main()
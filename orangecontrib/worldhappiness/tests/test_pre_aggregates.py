@@ -0,0 +1,105 @@
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from orangecontrib.worldhappiness.whstudy import world_data_api
+from orangecontrib.worldhappiness.whstudy.world_data_api import WorldIndicators
+
+LOCAL_URI = "mongodb://localhost:27017"
+TEST_DB_NAME = "world-database-test-aggregates"
+
+COUNTRIES = [
+    {"_id": "SVN", "name": "Slovenia", "indicators": {"A_B": {str(y): float(y - 2000) for y in range(2005, 2021)}}},
+    {"_id": "AUT", "name": "Austria", "indicators": {"A_B": {"2011": 4.0}, "C_D": {"2018": 1.0, "2020": 3.0}}},
+]
+INDICATORS = [{"_id": "A_B"}, {"_id": "C_D"}]
+
+
+class LocalIndicators(WorldIndicators):
+    def get_connection(self):
+        return self.client[TEST_DB_NAME]
+
+
+class TestPreAggregates(unittest.TestCase):
+    """ Stored aggregates on a local mongod, which implements `$merge`. """
+
+    @classmethod
+    def setUpClass(cls):
+        from pymongo import MongoClient
+        from pymongo.errors import PyMongoError
+
+        cls.client = MongoClient(LOCAL_URI, serverSelectionTimeoutMS=500)
+        try:
+            cls.client.admin.command("ping")
+        except PyMongoError:
+            cls.client.close()
+            raise unittest.SkipTest("local mongod is not running")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+
+    def setUp(self):
+        self.client.drop_database(TEST_DB_NAME)
+        self.handle = LocalIndicators("user", "password", disk_cache=False)
+        self.handle.client = self.client
+        db = self.handle.db
+        db.countries.insert_many(COUNTRIES)
+        db.indicators.insert_many(INDICATORS)
+        self.handle.refresh_metadata()
+
+    def tearDown(self):
+        self.client.drop_database(TEST_DB_NAME)
+
+    def published(self):
+        return self.handle.db.metadata.find_one({"_id": "aggregates"})
+
+    def test_stored_equal_computed(self):
+        self.handle.refresh_pre_aggregates()
+        countries, codes = ["SVN", "AUT", "XXX"], ["A_B", "C_D"]
+        for years, method in ((range(2016, 2021), "mean"), (range(2011, 2021), "max")):
+            self.handle.pre_aggregates_cache = None
+            self.assertIsNotNone(self.handle.pre_aggregate(years, method))
+            _, stored = self.handle.fetch_aggregates(countries, codes, years, method)
+            self.handle.pre_aggregates_cache = (self.handle.data_version_cache, {})
+            _, computed = self.handle.fetch_aggregates(countries, codes, years, method)
+            np.testing.assert_equal(stored, computed)
+
+    def test_rebuild_keeps_previous_collection(self):
+        db = self.handle.db
+        self.handle.refresh_pre_aggregates()
+        first = self.published()
+        self.handle.refresh_pre_aggregates()
+        second = self.published()
+        self.assertEqual(second["previous"], first["collection"])
+        self.assertIn(first["collection"], db.list_collection_names())
+
+        self.handle.refresh_pre_aggregates()
+        self.assertNotIn(first["collection"], db.list_collection_names())
+        self.assertIn(second["collection"], db.list_collection_names())
+
+    def test_failed_rebuild_keeps_published_collection(self):
+        db = self.handle.db
+        self.handle.refresh_pre_aggregates()
+        published = self.published()
+        collections = set(db.list_collection_names())
+
+        projection = world_data_api.aggregate_projection
+        calls = []
+
+        def failing(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 2:
+                raise RuntimeError
+            return projection(*args, **kwargs)
+
+        with patch.object(world_data_api, "aggregate_projection", failing):
+            with self.assertRaises(RuntimeError):
+                self.handle.refresh_pre_aggregates()
+        self.assertEqual(self.published(), published)
+        self.assertEqual(set(db.list_collection_names()), collections)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+from orangecontrib.worldhappiness.whstudy.cache import Series
+from orangecontrib.worldhappiness.whstudy.world_data_api import FetchedSeries
+
+
+def series(years, values=None, last=None):
+    return Series(frozenset(years), values or {}, last)
+
+
+class TestSeries(unittest.TestCase):
+    def test_covers(self):
+        s = series({"2010", "2011"}, {"2010": 1.0}, None)
+        self.assertTrue(s.covers(frozenset({"2010"})))
+        self.assertTrue(s.covers(frozenset({"2010", "2011"})))
+        # Years that were not fetched
+        self.assertFalse(s.covers(frozenset({"2010", "2012"})))
+
+    def test_covers_without_values(self):
+        # The last available year is needed when none of the years has a value
+        self.assertFalse(series({"2011"}, {}, None).covers(frozenset({"2011"})))
+        self.assertTrue(series({"2011"}, {}, ("2005", 3.0)).covers(frozenset({"2011"})))
+        self.assertTrue(series({"2011"}, {}, ()).covers(frozenset({"2011"})))
+
+    def test_merge(self):
+        a = series({"2010", "2011"}, {"2010": 1.0}, None)
+        b = series({"2012"}, {"2012": 2.0}, ("2012", 2.0))
+        merged = a.merge(b)
+        self.assertEqual(merged.years, {"2010", "2011", "2012"})
+        self.assertEqual(merged.values, {"2010": 1.0, "2012": 2.0})
+        self.assertEqual(merged.last, ("2012", 2.0))
+
+    def test_merge_keeps_known_last(self):
+        a = series({"2012"}, {}, ("2005", 3.0))
+        b = series({"2010"}, {"2010": 1.0}, None)
+        self.assertEqual(a.merge(b).last, ("2005", 3.0))
+        self.assertEqual(b.merge(a).last, ("2005", 3.0))
+
+
+class TestFetchedSeries(unittest.TestCase):
+    def setUp(self):
+        self.fetched = FetchedSeries(
+            {"SVN": "Slovenia", "AUT": "Austria"},
+            {
+                ("SVN", "A"): series({"2010", "2011"}, {"2010": 1.0, "2011": 2.0}),
+                ("SVN", "B"): series({"2010", "2011"}, {}, ("2001", 5.0)),
+                ("AUT", "A"): series({"2010"}, {"2010": 3.0}),
+                ("AUT", "B"): series({"2010", "2011"}, {"2011": 4.0}, ("2011", 4.0)),
+            },
+            "v1"
+        )
+
+    def test_missing_nothing(self):
+        self.assertEqual(self.fetched.missing(["SVN", "AUT"], ["A", "B"], [2010]), ([], [], []))
+        self.assertEqual(self.fetched.missing(["SVN"], ["A", "B"], [2010, 2011]), ([], [], []))
+
+    def test_missing_years(self):
+        self.assertEqual(self.fetched.missing(["SVN", "AUT"], ["A", "B"], [2010, 2011]),
+                         (["AUT"], ["A"], ["2011"]))
+        self.assertEqual(self.fetched.missing(["SVN", "AUT"], ["A", "B"], [2011, 2012]),
+                         (["SVN", "AUT"], ["A", "B"], ["2011", "2012"]))
+
+    def test_missing_countries_and_codes(self):
+        self.assertEqual(self.fetched.missing(["SVN", "HRV"], ["A"], [2010]), (["HRV"], ["A"], ["2010"]))
+        self.assertEqual(self.fetched.missing(["SVN", "AUT"], ["C", "A"], [2010]),
+                         (["SVN", "AUT"], ["C"], ["2010"]))
+
+    def test_missing_without_values(self):
+        # Fetched years without values and without the last available year are fetched again
+        fetched = FetchedSeries({"SVN": "Slovenia"}, {("SVN", "A"): series({"2010"}, {}, None)})
+        self.assertEqual(fetched.missing(["SVN"], ["A"], [2010]), (["SVN"], ["A"], ["2010"]))
+
+    def test_merge(self):
+        merged = self.fetched.merge(
+            {"HRV": "Croatia"},
+            {("AUT", "A"): series({"2011"}, {"2011": 6.0}), ("HRV", "A"): series({"2010"}, {"2010": 7.0})}
+        )
+        self.assertEqual(merged.names, {"SVN": "Slovenia", "AUT": "Austria", "HRV": "Croatia"})
+        self.assertEqual(merged.series[("AUT", "A")].values, {"2010": 3.0, "2011": 6.0})
+        self.assertEqual(merged.series[("HRV", "A")].values, {"2010": 7.0})
+        self.assertIs(merged.series[("SVN", "A")], self.fetched.series[("SVN", "A")])
+        self.assertEqual(merged.version, "v1")
+        self.assertEqual(merged.missing(["SVN", "AUT", "HRV"], ["A"], [2010, 2011]), (["HRV"], ["A"], ["2011"]))
+        # Original is not changed
+        self.assertEqual(self.fetched.series[("AUT", "A")].values, {"2010": 3.0})
+
+    def test_restrict(self):
+        restricted = self.fetched.restrict(["SVN", "HRV"], ["B"])
+        self.assertEqual(restricted.names, {"SVN": "Slovenia"})
+        self.assertEqual(list(restricted.series), [("SVN", "B")])
+        self.assertEqual(restricted.version, "v1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,15 @@
 """
 Module for world data fetching and loading.
 """
-from typing import List
+from typing import Dict, List, Optional, Tuple
+import warnings
 import numpy as np
 import re
 
-import pandas as pd
-from Orange.data import Table, table_from_frame, ContinuousVariable
+from Orange.data import Table, Domain, ContinuousVariable, StringVariable
 
 
-from orangecontrib.worldhappiness.whstudy.world_data_api import WorldIndicators
+from orangecontrib.worldhappiness.whstudy.world_data_api import WorldIndicators, indicator_code, sparse_masks
 
 GEO_REGIONS = [
     ('AFR', 'Africa',
@@ -50,12 +50,196 @@ ORGANIZATIONS = [
 ]
 
 
+def world_table(
+        countries: List[str],
+        names,
+        cols: List[str],
+        values: np.ndarray,
+        attributes: Optional[Dict[str, Dict]] = None,
+) -> Table:
+    """
+    Wrap values of countries into a Table without converting them to a data frame.
+
+    Parameters
+    ----------
+    countries : list of str
+        Country codes of rows
+    names : list of str or None
+        Country names of rows, omitted when None
+    cols : list of str
+        Names of columns
+    values : np.ndarray
+        Float array with a row for each country and a column for each name in cols
+    attributes : dict or None
+        Attributes of variables, such as the description, keyed by column name
+
+    Returns
+    -------
+    Table with values as attributes and country codes and names as metas.
+    """
+    attributes = attributes or {}
+    variables = []
+    for name in cols:
+        var = ContinuousVariable(name)
+        var.attributes.update(attributes.get(name) or {})
+        variables.append(var)
+
+    metas = [StringVariable("Country code")]
+    meta_values = [np.asarray(countries, dtype=object)]
+    if names is not None:
+        metas.append(StringVariable("Country name"))
+        meta_values.append(np.asarray(names, dtype=object))
+
+    domain = Domain(variables, metas=metas)
+    values = np.asarray(values, dtype=float).reshape(len(countries), len(cols))
+    return Table.from_numpy(domain, values, metas=np.column_stack(meta_values))
+
+
+def sparse_table(
+        countries: List[str],
+        names,
+        cols: List[str],
+        values: np.ndarray,
+        index_freq=0,
+        country_freq=0,
+        attributes: Optional[Dict[str, Dict]] = None,
+) -> Table:
+    """
+    Table of values without indicators and countries with too many missing
+    values. Variables are created only for kept columns.
+
+    Parameters
+    ----------
+    countries : list of str
+        Country codes of rows
+    names : np.ndarray
+        Country names of rows
+    cols : list of str
+        Names of columns
+    values : np.ndarray
+        Float array with a row for each country and a column for each name in cols
+    index_freq: float
+        Percentage of not NaN values to keep indicator
+    country_freq: float
+        Percentage of not NaN values to keep country
+    attributes : dict or None
+        Attributes of variables keyed by column name
+
+    Returns
+    -------
+    Table with values as attributes and country codes and names as metas.
+    """
+    columns, rows = sparse_masks(values, len(countries), index_freq, country_freq)
+    return world_table(
+        [country for country, keep in zip(countries, rows) if keep],
+        np.asarray(names)[rows],
+        [col for col, keep in zip(cols, columns) if keep],
+        values[np.ix_(rows, columns)],
+        attributes
+    )
+
+
+def year_cube(
+        cols: List[str],
+        values: np.ndarray,
+        codes: Optional[List[str]] = None,
+) -> Tuple[List[int], List[str], np.ndarray]:
+    """
+    Reshape values of columns named "year-code" into an array of countries, years
+    and indicators. Missing values are NaN.
+
+    Parameters
+    ----------
+    cols : list of str
+        Names of columns
+    values : np.ndarray
+        Float array with a row for each country and a column for each name in cols
+    codes : list of str or None
+        Order of indicators, order of their columns when None. Indicators
+        without columns have only missing values.
+
+    Returns
+    -------
+    Years and indicator codes in order of columns and an array of shape
+    (countries, years, indicators).
+    """
+    codes, years = {code: i for i, code in enumerate(codes or ())}, {}
+    code_index = np.empty(len(cols), dtype=int)
+    year_index = np.empty(len(cols), dtype=int)
+    for j, name in enumerate(cols):
+        code = indicator_code(name)
+        year = name[:len(name) - len(code)].rstrip('-')
+        code_index[j] = codes.setdefault(code, len(codes))
+        year_index[j] = years.setdefault(year, len(years))
+
+    cube = np.full((len(values), len(years), len(codes)), np.nan)
+    cube[:, year_index, code_index] = values
+    return [int(year) if year else 0 for year in years], list(codes), cube
+
+
+class YearStatistics:
+    """
+    Statistics of indicator values over years computed together by the
+    Statistics aggregation method.
+    """
+    COUNT, STD, LATEST, TREND = range(4)
+    ITEMS = "Count", "Std", "Latest", "Trend"
+
+    @staticmethod
+    def compute(cube: np.ndarray, years: List[int], statistics: List[int]) -> np.ndarray:
+        """
+        Compute statistics along the year axis of the cube.
+
+        Parameters
+        ----------
+        cube : np.ndarray
+            Values of shape (countries, years, indicators)
+        years : list of int
+            Years of the second axis of the cube
+        statistics : list of int
+            Statistics to compute. Count is the number of values, Std their
+            sample standard deviation, Latest the value of the last year with data
+            and Trend the least squares slope of values over years.
+
+        Returns
+        -------
+        Array of shape (countries, indicators, statistics).
+        """
+        order = np.argsort(years, kind="stable")
+        cube = cube[:, order]
+        present = ~np.isnan(cube)
+        count = present.sum(axis=1).astype(float)
+
+        results = []
+        with warnings.catch_warnings():
+            # Series with too few values give NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for statistic in statistics:
+                if statistic == YearStatistics.COUNT:
+                    results.append(count)
+                elif statistic == YearStatistics.STD:
+                    results.append(np.nanstd(cube, axis=1, ddof=1))
+                elif statistic == YearStatistics.LATEST:
+                    last = cube.shape[1] - 1 - np.argmax(present[:, ::-1], axis=1)
+                    results.append(np.take_along_axis(cube, last[:, None], axis=1)[:, 0])
+                elif statistic == YearStatistics.TREND:
+                    x = np.where(present, np.asarray(years, dtype=float)[order][None, :, None], np.nan)
+                    dx = x - np.nanmean(x, axis=1, keepdims=True)
+                    dy = cube - np.nanmean(cube, axis=1, keepdims=True)
+                    var = np.nansum(dx ** 2, axis=1)
+                    slope = np.nansum(dx * dy, axis=1) / np.where(var > 0, var, np.nan)
+                    results.append(np.where(count >= 2, slope, np.nan))
+        return np.stack(results, axis=2) if results else np.empty((len(cube), cube.shape[2], 0))
+
+
 class AggregationMethods:
     """
     Aggregation methods enum and helper functions.
     """
-    NONE, MEAN, MEDIAN, MIN, MAX = range(5)
-    ITEMS = "None", "Mean", "Median", "Min", "Max"
+    NONE, MEAN, MEDIAN, MIN, MAX, STATISTICS = range(6)
+    ITEMS = "None", "Mean", "Median", "Min", "Max", "Statistics"
+    # Names of methods the database can compute, see WorldIndicators.server_aggregation
+    SERVER_NAMES = {MEAN: "mean", MEDIAN: "median", MIN: "min", MAX: "max"}
 
     @staticmethod
     def aggregate(
@@ -64,6 +248,7 @@ class AggregationMethods:
             callback,
             index_freq=1,
             country_freq=1,
+            statistics=None,
     ) -> Table:
         """
         Aggregate scores.
@@ -73,52 +258,180 @@ class AggregationMethods:
         world_data : Table
             Table with data of countries for each indicator and year
         agg_method : int
-            Method type. One of: MEAN, MEDIAN, MIN, MAX.
+            Method type. One of: MEAN, MEDIAN, MIN, MAX, STATISTICS.
         country_freq: float
             Percentage of not NaN values to keep country
         index_freq: float
             Percentage of not NaN values to keep indicator
         callback: callback function
+        statistics: list of int or None
+            YearStatistics computed by the STATISTICS method, all if None.
+            Each gives a column named "code - statistic".
 
         Returns
         -------
         Aggregated indicator values by year.
         """
-        #agg_functions = [0, np.nanmean, np.nanmedian, np.nanmax, np.nanmin]
-        agg_functions = [0, 'nanmean', 'nanmedian', 'nanmax', 'nanmin']
-
         if agg_method == AggregationMethods.NONE:
             return world_data
         else:
-            callback(0.8, 'Aggregating data ...')
-            x_df, _, m_df = world_data.to_pandas_dfs()
-            cols = []
-            for i in world_data.domain.attributes:
-                name = i.name.split('-')[1]
-                if name not in cols:
-                    cols.append(name)
-
-            countries = list(m_df['Country code'])
-            df = pd.DataFrame(data=None, index=countries, columns=cols, dtype=float)
-
-            row_count = world_data.X_df.shape[0]
-            for step in range(row_count):
-                callback(0.8 + 0.2 * step / row_count, 'Aggregating data ...')
-                ind_step = 0
-                for indicator in cols:
-                    selection = x_df.iloc[step, :].filter(regex=indicator)
-                    df.iloc[step, ind_step] = selection.agg(func=agg_functions[agg_method])
-                    ind_step += 1
-
-            if m_df.shape[1] > 1:
-                df.insert(loc=0, column='Country name', value=list(m_df['Country name']))
-
-            # Remove indicator based on percantage of NaN countries
-            min_count = max(row_count * index_freq * 0.01, 1)
-            df = df.dropna(thresh=min_count, axis=1)
-
-            # Remove country based on percentage of NaN indicators
-            min_count = max(len(cols) * country_freq * 0.01, 2)
-            df = df.dropna(thresh=min_count, axis=0)
-
-            return table_from_frame(df)
+            domain = world_data.domain
+            metas = {var.name: world_data.metas[:, i] for i, var in enumerate(domain.metas)}
+            return AggregationMethods.aggregate_values(
+                list(metas['Country code']), metas.get('Country name'), [attr.name for attr in domain.attributes],
+                world_data.X, agg_method, callback, index_freq=index_freq, country_freq=country_freq,
+                statistics=statistics, attributes={attr.name: attr.attributes for attr in domain.attributes}
+            )
+
+    @staticmethod
+    def aggregate_values(
+            countries: List[str],
+            names,
+            cols: List[str],
+            values: np.ndarray,
+            agg_method: int,
+            callback,
+            index_freq=1,
+            country_freq=1,
+            statistics=None,
+            attributes=None,
+            codes=None,
+    ) -> Table:
+        """
+        Aggregate scores given as an array, without a table of years.
+
+        Parameters
+        ----------
+        countries : list of str
+            Country codes of rows
+        names : list of str or None
+            Country names of rows, omitted when None
+        cols : list of str
+            Names of columns, "year-code" for each indicator and year
+        values : np.ndarray
+            Float array with a row for each country and a column for each name in cols
+        agg_method : int
+            Method type. One of: MEAN, MEDIAN, MIN, MAX, STATISTICS.
+        callback: callback function
+        country_freq: float
+            Percentage of not NaN values to keep country
+        index_freq: float
+            Percentage of not NaN values to keep indicator
+        statistics: list of int or None
+            YearStatistics computed by the STATISTICS method, all if None.
+            Each gives a column named "code - statistic".
+        attributes : dict or None
+            Attributes of variables keyed by column name
+        codes : list of str or None
+            Order of aggregated indicators, order of their columns when None
+
+        Returns
+        -------
+        Aggregated indicator values by year.
+        """
+        callback(0.8, 'Aggregating data ...')
+        # Aggregated columns keep attributes of columns of their indicator
+        attributes = attributes or {}
+        source = {indicator_code(name): attributes.get(name) for name in cols}
+        years, cols, cube = year_cube(cols, values, codes)
+        present = None
+        if agg_method == AggregationMethods.STATISTICS:
+            statistics = list(range(len(YearStatistics.ITEMS))) if statistics is None else list(statistics)
+            values = YearStatistics.compute(cube, years, statistics)
+            # Count of a series without values is not a value of the indicator
+            present = ~np.isnan(values)
+            is_count = np.array(statistics) == YearStatistics.COUNT
+            present[:, :, is_count] &= values[:, :, is_count] > 0
+            values = values.reshape(len(values), -1)
+            present = present.reshape(len(present), -1)
+            attributes = {f"{code} - {YearStatistics.ITEMS[statistic]}": source.get(code)
+                          for code in cols for statistic in statistics}
+            cols = list(attributes)
+        else:
+            attributes = {code: source.get(code) for code in cols}
+            values = AggregationMethods.aggregate_cube(cube, agg_method)
+
+        return AggregationMethods.aggregated_table(countries, names, cols, values, index_freq=index_freq,
+                                                   country_freq=country_freq, attributes=attributes,
+                                                   present=present)
+
+    @staticmethod
+    def aggregate_cube(cube: np.ndarray, agg_method: int) -> np.ndarray:
+        """
+        Aggregate values over years with one of MEAN, MEDIAN, MIN, MAX.
+
+        Parameters
+        ----------
+        cube : np.ndarray
+            Values of shape (countries, years, indicators)
+        agg_method : int
+            Method type
+
+        Returns
+        -------
+        Array of shape (countries, indicators).
+        """
+        agg_functions = [None, np.nanmean, np.nanmedian, np.nanmin, np.nanmax]
+        with warnings.catch_warnings():
+            # Indicators without values in any year aggregate to NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return agg_functions[agg_method](cube, axis=1)
+
+    @staticmethod
+    def aggregated_table(
+            countries: List[str],
+            names,
+            cols: List[str],
+            values: np.ndarray,
+            index_freq=1,
+            country_freq=1,
+            attributes=None,
+            present=None,
+    ) -> Table:
+        """
+        Remove sparse indicators and countries from aggregated values.
+        Variables are created only for kept columns.
+
+        Parameters
+        ----------
+        countries : list of str
+            Country codes of rows
+        names : list of str or None
+            Country names of rows, omitted when None
+        cols : list of str
+            Names of columns
+        values : np.ndarray
+            Aggregated values with a row for each country
+        country_freq: float
+            Percentage of not NaN values to keep country
+        index_freq: float
+            Percentage of not NaN values to keep indicator
+        attributes : dict or None
+            Attributes of variables keyed by column name
+        present : np.ndarray or None
+            Boolean array of values counted as present by index_freq and
+            country_freq, values that are not NaN when None
+
+        Returns
+        -------
+        Table of aggregated values.
+        """
+        if present is None:
+            present = ~np.isnan(values)
+
+        # Remove indicator based on percantage of NaN countries
+        min_count = max(len(countries) * index_freq * 0.01, 1)
+        columns = np.count_nonzero(present, axis=0) >= min_count
+
+        # Remove country based on percentage of NaN indicators, a name counts as a value;
+        # columns without any value are not counted, as they are missing from data of years
+        min_count = max(np.count_nonzero(present.any(axis=0)) * country_freq * 0.01, 2)
+        rows = np.count_nonzero(present[:, columns], axis=1) + (names is not None) >= min_count
+
+        return world_table(
+            [country for country, keep in zip(countries, rows) if keep],
+            np.asarray(names)[rows] if names is not None else None,
+            [col for col, keep in zip(cols, columns) if keep],
+            values[np.ix_(rows, columns)],
+            attributes
+        )
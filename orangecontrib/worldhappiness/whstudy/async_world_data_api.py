@@ -0,0 +1,129 @@
+# -----------------------------------------------------------
+# Asyncio backend of the World Indicators library. Chunks of
+# countries are fetched concurrently to overlap network latency.
+# -----------------------------------------------------------
+import asyncio
+
+import bson
+from Orange.util import dummy_callback
+
+from orangecontrib.worldhappiness.whstudy.world_data_api import DB_NAME, QUERY_BATCH_SIZE, connection_uri, \
+    decode_series, indicator_from_doc, series_projection, series_values, sparse_frame
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:  # pymongo < 4.10
+    AsyncMongoClient = None
+
+# Maximal number of chunk queries running at the same time
+MAX_CONCURRENCY = 8
+
+
+class AsyncWorldIndicators:
+    """ Asyncio counterpart of WorldIndicators with coroutine methods countries,
+    years, indicators and data. Fetched series are not cached locally.
+    """
+
+    def __init__(self, user, password, max_concurrency=MAX_CONCURRENCY):
+        if AsyncMongoClient is None:
+            raise ImportError("AsyncWorldIndicators requires pymongo>=4.10.")
+        self.user = user
+        self.pwd = password
+        self.max_concurrency = max_concurrency
+        self.db = self.get_connection()
+
+        # Cache results of countries, years and indicators
+        self.countries_cache = None
+        self.years_cache = None
+        self.indicators_cache = None
+
+        # Statistics of the last data query
+        self.last_query_stats = {"round_trips": 0, "bytes_received": 0}
+
+    def get_connection(self):
+        """ Set up asyncio connection to remote mongoDB database
+        :return: database object
+        """
+        client = AsyncMongoClient(connection_uri(self.user, self.pwd))
+        return client[DB_NAME]
+
+    async def countries(self):
+        """ Function gets data from remote database.
+        :return: list of countries with country codes and names
+        """
+        if self.countries_cache is None:
+            cursor = self.db.countries.find({}, {'_id': 1, 'name': 1})
+            self.countries_cache = [(doc['_id'], doc['name']) async for doc in cursor]
+        return self.countries_cache
+
+    async def years(self):
+        """ Function gets data from remote database.
+        :return: list of years with data
+        """
+        if self.years_cache is None:
+            doc = await self.db.metadata.find_one({"_id": "years"}, {"years": 1})
+            if doc is not None:
+                years = set(doc['years'])
+            else:
+                # Database without metadata document, derive years from a single country
+                cursor = self.db.countries.find({"_id": {"$in": ["SVN"]}}, {"indicators": 1})
+                years = {year async for doc in cursor for val in doc['indicators'].values() for year in val.keys()}
+            self.years_cache = sorted(years, reverse=True)
+        return self.years_cache
+
+    async def indicators(self):
+        """ Function gets data from remote database.
+        :return: list of indicators
+        """
+        if self.indicators_cache is None:
+            self.indicators_cache = [indicator_from_doc(doc) async for doc in self.db.indicators.find({})]
+        return self.indicators_cache
+
+    async def find_countries(self, countries, projection, semaphore):
+        """ Fetch country documents of a chunk of countries with one `$in` query.
+        :return: list of country documents
+        """
+        async with semaphore:
+            pipeline = [{"$match": {"_id": {"$in": countries}}}, {"$project": projection}]
+            cursor = await self.db.countries.aggregate(pipeline, batchSize=len(countries))
+            docs = await cursor.to_list()
+        self.last_query_stats["round_trips"] += 1
+        self.last_query_stats["bytes_received"] += sum(len(bson.encode(doc)) for doc in docs)
+        return docs
+
+    async def data(self, countries, indicators, year, include_country_names=True, callback=dummy_callback,
+                   index_freq=0, country_freq=0, batch_size=QUERY_BATCH_SIZE):
+        """ Function gets data from remote database with concurrent queries.
+        Parameters and result are the same as in WorldIndicators.data.
+        :return: Pandas dataframe
+        """
+        if type(year) is int:
+            year = [year]
+        countries = list(countries)
+        codes = [str.replace(i, '.', '_') for i in indicators]
+        years = frozenset(str(y) for y in year)
+
+        callback(0, "Fetching data ...")
+
+        self.last_query_stats = {"round_trips": 0, "bytes_received": 0}
+        projection = series_projection(codes, year)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        chunks = [asyncio.ensure_future(self.find_countries(countries[i:i + batch_size], projection, semaphore))
+                  for i in range(0, len(countries), batch_size)]
+
+        country_names, series = {}, {}
+        try:
+            for step, chunk in enumerate(asyncio.as_completed(chunks), 1):
+                for doc in await chunk:
+                    country_names[doc['_id']] = doc['name']
+                    for code, country_series in decode_series(doc, codes, years).items():
+                        series[(doc['_id'], code)] = country_series
+                callback(step / len(chunks) * 0.8, "Fetching data ...")
+        finally:
+            # Chunks still running when the query fails or is interrupted are cancelled
+            for chunk in chunks:
+                chunk.cancel()
+            await asyncio.gather(*chunks, return_exceptions=True)
+
+        cols, values, names = series_values(countries, indicators, year, country_names, series)
+        return sparse_frame(countries, cols, values, names, index_freq, country_freq, include_country_names)
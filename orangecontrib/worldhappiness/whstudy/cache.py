@@ -0,0 +1,239 @@
+# -----------------------------------------------------------
+# Local caches of indicator series fetched from the remote
+# world database.
+# -----------------------------------------------------------
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from itertools import product
+from typing import NamedTuple, FrozenSet, Dict, Optional, Tuple
+
+from Orange.misc.environ import cache_dir
+
+
+class Series(NamedTuple):
+    """ Indicator series of a country restricted to the years it was fetched for.
+    `last` holds the last stored (year, value) pair, an empty tuple when the series
+    is empty and None when it is not known.
+    """
+    years: FrozenSet[str]
+    values: Dict[str, float]
+    last: Optional[Tuple]
+
+    def covers(self, years):
+        """ Can the series answer a query for given years (set of str) without the database.
+        """
+        if not years <= self.years:
+            return False
+        return self.last is not None or any(y in self.values for y in years)
+
+    def merge(self, other):
+        """ Combine with series fetched for other years.
+        """
+        return Series(
+            self.years | other.years,
+            {**self.values, **other.values},
+            other.last if other.last is not None else self.last
+        )
+
+
+def series_size(series):
+    """ Approximate memory footprint of series in bytes.
+    """
+    size = sys.getsizeof(series.years) + sys.getsizeof(series.values) + sys.getsizeof(series.last)
+    for year, value in series.values.items():
+        size += sys.getsizeof(year) + sys.getsizeof(value)
+    return size
+
+
+class MemoryCache:
+    """ Least recently used cache of series bounded by their approximate size in bytes.
+    Counters `hits` and `misses` count lookups of (country, code) pairs, `evictions`
+    the number of series dropped to keep within `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.names = {}
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, countries, codes, years):
+        """ Read stored names and series. Lookups of series that do not cover
+        given years are counted as misses.
+        :param countries: list of country codes
+        :param codes: list of indicator codes with underscores
+        :param years: set of years as str
+        :return: dict of country names and dict of Series keyed by (country, code)
+        """
+        names, series = {}, {}
+        with self._lock:
+            for country in countries:
+                if country in self.names:
+                    names[country] = self.names[country]
+                for code in codes:
+                    key = (country, code)
+                    entry = self._series.get(key)
+                    if entry is None:
+                        self.misses += 1
+                        continue
+                    if entry[0].covers(years):
+                        self.hits += 1
+                    else:
+                        self.misses += 1
+                    self._series.move_to_end(key)
+                    series[key] = entry[0]
+        return names, series
+
+    def put(self, names, series):
+        """ Store names and series and evict least recently used series over budget.
+        :param names: dict of country names
+        :param series: dict of Series keyed by (country, code)
+        """
+        with self._lock:
+            self.names.update(names)
+            for key, s in series.items():
+                if key in self._series:
+                    self.nbytes -= self._series.pop(key)[1]
+                size = series_size(s)
+                if size <= self.max_bytes:
+                    self._series[key] = (s, size)
+                    self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._series.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.names.clear()
+            self._series.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._series)
+
+
+def default_cache_path():
+    return os.path.join(cache_dir(), "worldhappiness", "series.sqlite")
+
+
+class DiskCache:
+    """ SQLite store of country names and indicator series.
+    Stored data is valid for a single version of the remote database.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS names (country TEXT PRIMARY KEY, name TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS series ("
+                         "country TEXT, code TEXT, years TEXT, vals TEXT, last TEXT, "
+                         "PRIMARY KEY (country, code))")
+
+    def _connect(self):
+        # Connections are not shared because queries run on worker threads
+        return sqlite3.connect(self.path)
+
+    def validate(self, version):
+        """ Drop all stored data if it belongs to another version of database.
+        :param version: version marker of the remote database, None if unknown
+        """
+        if version is None:
+            return
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or row[0] != version:
+                conn.execute("DELETE FROM names")
+                conn.execute("DELETE FROM series")
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+
+    def get(self, countries, codes):
+        """ Read stored names and series.
+        :param countries: list of country codes
+        :param codes: list of indicator codes with underscores
+        :return: dict of country names and dict of Series keyed by (country, code)
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TEMP TABLE keys (country TEXT, code TEXT)")
+            conn.executemany("INSERT INTO keys VALUES (?, ?)", product(countries, codes))
+            rows = conn.execute("SELECT s.country, s.code, s.years, s.vals, s.last FROM series s "
+                                "JOIN keys k ON s.country = k.country AND s.code = k.code").fetchall()
+            names = conn.execute("SELECT country, name FROM names WHERE country IN "
+                                 "(SELECT DISTINCT country FROM keys)").fetchall()
+
+        series = {}
+        for country, code, years, values, last in rows:
+            last = json.loads(last)
+            series[(country, code)] = Series(
+                frozenset(json.loads(years)),
+                json.loads(values),
+                tuple(last) if last is not None else None
+            )
+        return dict(names), series
+
+    def put(self, names, series):
+        """ Store names and series.
+        :param names: dict of country names
+        :param series: dict of Series keyed by (country, code)
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO names VALUES (?, ?)", names.items())
+            conn.executemany(
+                "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)",
+                ((country, code, json.dumps(sorted(s.years)), json.dumps(s.values), json.dumps(s.last))
+                 for (country, code), s in series.items())
+            )
+
+
+def default_catalog_path():
+    return os.path.join(cache_dir(), "worldhappiness", "catalog.json.gz")
+
+
+class CatalogCache:
+    """ Compressed JSON file with the catalog of the remote database: lists of countries,
+    years and indicators, the version of database they belong to and the time of the
+    last version check.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_catalog_path()
+
+    @staticmethod
+    def empty(version=None):
+        return {"version": version, "checked": 0, "parts": {}}
+
+    def load(self):
+        """ Read the stored catalog.
+        :return: dict with keys version, checked and parts, None if there is no valid file
+        """
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # JSON has no tuples, entries of countries and indicators are restored
+        stored["parts"] = {key: [tuple(v) if isinstance(v, list) else v for v in values]
+                           for key, values in stored["parts"].items()}
+        return stored
+
+    def save(self, stored):
+        """ Write the catalog, replacing the previous file at once.
+        :param stored: dict with keys version, checked and parts
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(stored, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
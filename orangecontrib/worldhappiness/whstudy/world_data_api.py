@@ -6,20 +6,38 @@
 # -----------------------------------------------------------
 import time
 
-import wbgapi as wb
 import json
 import numpy as np
 import pandas as pd
-from requests import HTTPError
 
 import datetime
-from pymongo import MongoClient
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import NamedTuple, Dict, Optional, Tuple
+
 from Orange.util import dummy_callback
 
+from orangecontrib.worldhappiness.whstudy.cache import CatalogCache, DiskCache, MemoryCache, Series
+
 MONGODB_HOST = 'cluster0.vxftj.mongodb.net'
 MONGODB_PORT = 27017
 DB_NAME = 'world-database'
 
+# Number of countries requested with a single `$in` query
+QUERY_BATCH_SIZE = 50
+# Memory budget of cached indicator series in bytes
+MEMORY_CACHE_SIZE = 128 * 2 ** 20
+# Seconds to wait for the version marker before working from the local cache
+VERSION_TIMEOUT = 5
+# Seconds the stored catalog is used without checking the version of database
+CATALOG_TTL = 24 * 60 * 60
+# Year aggregations computed by the database and the server version they need
+SERVER_AGGREGATIONS = {"mean": (3, 2), "min": (3, 2), "max": (3, 2), "median": (5, 2)}
+# Numbers of latest years aggregated in advance by update()
+PRE_AGGREGATE_WINDOWS = (5, 10)
+# Number of indicators aggregated in advance by a single `$merge` pass
+PRE_AGGREGATE_BATCH_SIZE = 1000
+
 
 def find_country_name(name):
     # Needed only for update not addon
@@ -31,7 +49,28 @@ def find_country_alpha2(name):
     return name
 
 
+def connection_uri(user, password):
+    return f"mongodb+srv://{user}:{password}@{MONGODB_HOST}/{DB_NAME}?retryWrites=true&w=majority"
+
+
+def indicator_from_doc(doc):
+    """ Converts indicator document to tuple of form
+    (db, code, desc, code_exp, is_relative, url, sparse_indicator).
+    """
+    return (
+        doc['db'],
+        str.replace(doc['_id'], '_', '.'),
+        doc['desc'],
+        doc['code_exp'] if 'code_exp' in doc else [],
+        doc['is_relative'] if 'is_relative' in doc else '',
+        doc['url'] if 'url' in doc else '',
+        doc['sparse_indicator']
+    )
+
+
 def find_indicator_desc(code, db):
+    import wbgapi as wb
+
     if db == 'WDI' or db == 'WDB':
         indicator = list(wb.series.list(code))
         if len(indicator) == 0:
@@ -42,80 +81,810 @@ def find_indicator_desc(code, db):
         return ""
 
 
+def selected_series(codes, years):
+    """ Builds expression of an array with element {'k': code, 'all': pairs, 'requested': pairs}
+    for each stored series of given codes, where pairs are {'k': year, 'v': value} of all stored
+    years and of requested years. Codes and years appear in the expression only once, so its
+    size does not grow with the number of codes times the number of years.
+    :param codes: list of indicator codes with underscores
+    :type codes: list
+    :param years: list of years as str
+    :type years: list
+    :return: dict
+    """
+    return {'$let': {'vars': {'years': years}, 'in': {'$map': {
+        'input': {'$filter': {
+            'input': {'$objectToArray': {'$ifNull': ['$indicators', {}]}},
+            'as': 'series', 'cond': {'$in': ['$$series.k', codes]}
+        }},
+        'as': 'series',
+        'in': {'$let': {'vars': {'all': {'$objectToArray': '$$series.v'}}, 'in': {
+            'k': '$$series.k',
+            'all': '$$all',
+            'requested': {'$filter': {'input': '$$all', 'as': 'kv', 'cond': {'$in': ['$$kv.k', '$$years']}}}
+        }}}
+    }}}}
+
+
+def series_projection(codes, years):
+    """ Builds `$project` stage that keeps only requested years of indicator series.
+    For every series `values.<code>` holds values of requested years. When none of
+    them is stored, `last.<code>` holds the last stored pair {'k': year, 'v': value}.
+    :param codes: list of indicator codes with underscores
+    :type codes: list
+    :param years: list of years
+    :type years: list
+    :return: dict
+    """
+    series = selected_series(codes, [str(y) for y in years])
+    values = {'$arrayToObject': {'$map': {
+        'input': series, 'as': 's', 'in': {'k': '$$s.k', 'v': {'$arrayToObject': '$$s.requested'}}
+    }}}
+    last = {'$arrayToObject': {'$map': {
+        'input': {'$filter': {'input': series, 'as': 's', 'cond': {'$and': [
+            {'$eq': [{'$size': '$$s.requested'}, 0]},
+            {'$gt': [{'$size': '$$s.all'}, 0]}
+        ]}}},
+        'as': 's', 'in': {'k': '$$s.k', 'v': {'$arrayElemAt': ['$$s.all', -1]}}
+    }}}
+    return {'_id': 1, 'name': 1, 'values': values, 'last': last}
+
+
+def aggregate_projection(codes, years, method):
+    """ Builds `$project` stage that aggregates requested years of indicator series.
+    For every series `values.<code>` holds the aggregate of values of requested years.
+    When none of them is stored it holds the last stored value, as the column of the
+    last available year does in series_frame.
+    :param codes: list of indicator codes with underscores
+    :type codes: list
+    :param years: list of years
+    :type years: list
+    :param method: one of SERVER_AGGREGATIONS
+    :type method: str
+    :return: dict
+    """
+    def aggregated(values):
+        if method == "median":
+            # Average of the middle elements, equal to numpy's median
+            middle = [{'$toInt': {'$divide': [{'$subtract': ['$$n', 1]}, 2]}}, {'$toInt': {'$divide': ['$$n', 2]}}]
+            return {'$let': {
+                'vars': {'sorted': {'$sortArray': {'input': values, 'sortBy': 1}}, 'n': {'$size': values}},
+                'in': {'$avg': [{'$arrayElemAt': ['$$sorted', i]} for i in middle]}
+            }}
+        return {{"mean": "$avg", "min": "$min", "max": "$max"}[method]: values}
+
+    series = selected_series(codes, [str(y) for y in years])
+    values = {'$arrayToObject': {'$map': {
+        'input': {'$filter': {'input': series, 'as': 's', 'cond': {'$gt': [{'$size': '$$s.all'}, 0]}}},
+        'as': 's',
+        'in': {'k': '$$s.k', 'v': {'$cond': [
+            {'$eq': [{'$size': '$$s.requested'}, 0]},
+            {'$arrayElemAt': ['$$s.all.v', -1]},
+            aggregated('$$s.requested.v')
+        ]}}
+    }}}
+    return {'_id': 1, 'name': 1, 'values': values}
+
+
+def decode_series(doc, codes, years):
+    """ Decodes series of a country document projected with series_projection.
+    :param doc: country document
+    :param codes: list of indicator codes with underscores
+    :param years: set of requested years as str
+    :return: dict of Series keyed by code
+    """
+    last_docs = doc.get('last', {})
+    series = {}
+    for code in codes:
+        values = doc['values'].get(code, {})
+        last = last_docs.get(code)
+        if last is not None:
+            last = (last['k'], last['v'])
+        elif not values:
+            # Series without any stored value
+            last = ()
+        series[code] = Series(years, values, last)
+    return series
+
+
+def frame_layout(indicators, year):
+    """ Columns of the value array and positions of indicator years in it.
+    :param indicators: list of indicator codes
+    :type indicators: list
+    :param year: list of years
+    :type year: list
+    :return: list of column names and list of (indicator, code, [(year, column)])
+    """
+    if len(year) > 1:
+        cols = [f"{y}-{i}" for i in indicators for y in year]
+    else:
+        cols = list(indicators)
+
+    layout = []
+    for k, i in enumerate(indicators):
+        # Must change indicator code to underscores because of Mongo naming restrictions
+        code = str.replace(i, '.', '_')
+        layout.append((i, code, [(str(y), k * len(year) + j) for j, y in enumerate(year)]))
+    return cols, layout
+
+
+def indicator_code(column):
+    """ Indicator code of a column named by frame_layout.
+    :param column: column name, "year-code" for multiple years or "code"
+    :type column: str
+    :return: indicator code
+    """
+    year, sep, code = column.partition('-')
+    return code if sep and year.isdigit() else column
+
+
+def fill_rows(values, names, countries, layout, country_names, series):
+    """ Writes series of countries into rows of the value array and the array of names.
+    Arrays can be views of a block of rows of larger arrays.
+    :param values: float array with a row for each country
+    :param names: object array with a name for each country
+    :param countries: list of country codes
+    :param layout: positions of indicator years from frame_layout
+    :param country_names: dict of country names
+    :param series: dict of Series keyed by (country, code)
+    :return: dict of columns of last available years for given rows
+    """
+    # Columns of last available years are added on demand
+    last_year_cols = {}
+    for row, country in enumerate(countries):
+        if country not in country_names:
+            continue
+        names[row] = country_names[country]
+        for i, code, year_cols in layout:
+            country_series = series[(country, code)]
+
+            get_last_available_year = True
+            for y, col in year_cols:
+                if y in country_series.values:
+                    values[row, col] = country_series.values[y]
+                    get_last_available_year = False
+
+            if get_last_available_year and country_series.last:
+                last_year, last_value = country_series.last
+                name = f"{last_year}-{i}"
+                if name not in last_year_cols:
+                    last_year_cols[name] = np.full(len(countries), np.nan)
+                last_year_cols[name][row] = last_value
+    return last_year_cols
+
+
+def stack_last_years(cols, values, last_year_cols):
+    """ Appends columns of last available years to the value array.
+    :return: list of column names and float array of values
+    """
+    if last_year_cols:
+        values = np.column_stack([values, *last_year_cols.values()])
+        cols = cols + list(last_year_cols)
+    return cols, values
+
+
+def values_frame(countries, cols, values, names, include_country_names=True):
+    """ Wraps filled arrays into Pandas dataframe at once.
+    :return: Pandas dataframe
+    """
+    df = pd.DataFrame(values, index=pd.Index(countries, name="Country code"), columns=cols)
+
+    # Add country name column
+    if include_country_names:
+        df.insert(0, "Country name", names)
+    return df
+
+
+def series_values(countries, indicators, year, country_names, series):
+    """ Decodes fetched series of countries into arrays.
+    :param countries: list of country codes
+    :type countries: list
+    :param indicators: list of indicator codes
+    :type indicators: list
+    :param year: list of years
+    :type year: list
+    :param country_names: dict of country names
+    :param series: dict of Series keyed by (country, code)
+    :return: list of column names, float array of values and object array of country names
+    """
+    cols, layout = frame_layout(indicators, year)
+    values = np.full((len(countries), len(cols)), np.nan)
+    names = np.full(len(countries), str(np.nan), dtype=object)
+    last_year_cols = fill_rows(values, names, countries, layout, country_names, series)
+    cols, values = stack_last_years(cols, values, last_year_cols)
+    return cols, values, names
+
+
+def series_frame(countries, indicators, year, country_names, series, include_country_names=True):
+    """ Builds Pandas dataframe of countries from fetched series.
+    :param countries: list of country codes
+    :type countries: list
+    :param indicators: list of indicator codes
+    :type indicators: list
+    :param year: list of years
+    :type year: list
+    :param country_names: dict of country names
+    :param series: dict of Series keyed by (country, code)
+    :param include_country_names: add collumn with country names
+    :return: Pandas dataframe
+    """
+    cols, values, names = series_values(countries, indicators, year, country_names, series)
+    return values_frame(countries, cols, values, names, include_country_names)
+
+
+class FetchedSeries(NamedTuple):
+    """ Country names and series fetched for a selection of countries and indicators
+    from the given version of the database.
+    """
+    names: Dict[str, str]
+    series: Dict[Tuple[str, str], Series]
+    version: Optional[str] = None
+
+    def missing(self, countries, codes, year):
+        """ Countries, codes and years that have to be fetched to cover the selection.
+        :param countries: list of country codes
+        :param codes: list of indicator codes with underscores
+        :param year: list of years
+        :return: list of countries, list of codes and list of years
+        """
+        years = frozenset(str(y) for y in year)
+        missing_countries, missing_codes, missing_years = [], set(), set()
+        for country in countries:
+            uncovered = [code for code in codes if country not in self.names
+                         or (country, code) not in self.series
+                         or not self.series[(country, code)].covers(years)]
+            if uncovered:
+                missing_countries.append(country)
+                missing_codes.update(uncovered)
+            for code in uncovered:
+                known = self.series[(country, code)].years if (country, code) in self.series else frozenset()
+                missing_years.update(years - known or years)
+        return missing_countries, [code for code in codes if code in missing_codes], sorted(missing_years)
+
+    def merge(self, names, series):
+        """ Add series fetched for other countries, indicators or years.
+        :return: FetchedSeries
+        """
+        merged = dict(self.series)
+        for key, country_series in series.items():
+            merged[key] = merged[key].merge(country_series) if key in merged else country_series
+        return FetchedSeries({**self.names, **names}, merged, self.version)
+
+    def restrict(self, countries, codes):
+        """ Drop series of countries and indicators that are not selected anymore.
+        :return: FetchedSeries
+        """
+        countries, codes = set(countries), set(codes)
+        return FetchedSeries(
+            {country: name for country, name in self.names.items() if country in countries},
+            {key: s for key, s in self.series.items() if key[0] in countries and key[1] in codes},
+            self.version
+        )
+
+
+def sparse_masks(values, n_countries, index_freq=0, country_freq=0, include_country_names=True):
+    """ Finds indicators and countries with enough values from counts of values of the array,
+    so that dropped ones never have to be copied into a dataframe or a table.
+    :param values: float array with a row for each country
+    :param n_countries: number of requested countries
+    :param index_freq: percentage of not NaN values to keep indicator
+    :param country_freq: percentage of not NaN values to keep country
+    :param include_country_names: column with country names counts as a value of each country
+    :return: boolean mask of kept columns and boolean mask of kept rows
+    """
+    present = ~np.isnan(values)
+
+    # Remove indicator based on percantage of NaN countries
+    min_count = max(n_countries * index_freq * 0.01, 1)
+    columns = np.count_nonzero(present, axis=0) >= min_count
+
+    # Remove country based on percentage of NaN indicators
+    min_count = max((np.count_nonzero(columns) + include_country_names) * country_freq * 0.01, 1)
+    rows = np.count_nonzero(present[:, columns], axis=1) + include_country_names >= min_count
+    return columns, rows
+
+
+def sparse_frame(countries, cols, values, names, index_freq=0, country_freq=0, include_country_names=True):
+    """ Builds Pandas dataframe of countries without indicators and countries with too many
+    missing values.
+    :param countries: list of country codes
+    :param cols: list of column names
+    :param values: float array with a row for each country
+    :param names: object array of country names
+    :param index_freq: percentage of not NaN values to keep indicator
+    :param country_freq: percentage of not NaN values to keep country
+    :param include_country_names: add collumn with country names
+    :return: Pandas dataframe
+    """
+    columns, rows = sparse_masks(values, len(countries), index_freq, country_freq, include_country_names)
+    return values_frame(
+        [country for country, keep in zip(countries, rows) if keep],
+        [col for col, keep in zip(cols, columns) if keep],
+        values[np.ix_(rows, columns)],
+        names[rows],
+        include_country_names
+    )
+
+
 class WorldIndicators:
 
-    def __init__(self, user, password):
+    def __init__(self, user, password, disk_cache=True, memory_cache_size=MEMORY_CACHE_SIZE,
+                 catalog_ttl=CATALOG_TTL):
         self.user = user
         self.pwd = password
-        self.db = self.get_connection()
+
+        # Connection is set up on first use
+        self._db = None
+        self._db_lock = threading.Lock()
 
         # Cache results of countries, years and indicators
         self.countries_cache = None
         self.years_cache = None
         self.indicators_cache = None
 
+        # Catalog persisted between sessions, checked against the database once per session
+        self.catalog_cache = CatalogCache() if disk_cache else None
+        self.catalog_ttl = catalog_ttl
+        self.stored_catalog = None
+        self.catalog_lock = threading.Lock()
+
+        # In-process and persistent caches of fetched indicator series
+        self.memory_cache = MemoryCache(memory_cache_size) if memory_cache_size else None
+        self.disk_cache = DiskCache() if disk_cache else None
+        self.data_version_cache = None
+        self.server_version_cache = None
+        # Windows of stored aggregates and the version of database they were read for
+        self.pre_aggregates_cache = None
+
+        # Statistics of the last data query
+        self.last_query_stats = {"round_trips": 0, "bytes_received": 0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def db(self):
+        with self._db_lock:
+            if self._db is None:
+                self._db = self.get_connection()
+        return self._db
+
     def get_connection(self):
         """ Set up connection to local mongoDB database
         :return: database object
         """
-        uri = f"mongodb+srv://{self.user}:{self.pwd}@{MONGODB_HOST}/{DB_NAME}?retryWrites=true&w=majority"
-        client = MongoClient(uri)
+        # pymongo is imported only when the database is first used
+        from pymongo import MongoClient
+
+        client = MongoClient(connection_uri(self.user, self.pwd))
         return client[DB_NAME]
 
+    def catalog(self, key, fetch):
+        """ Gets a part of catalog from the file stored by previous sessions or from
+        the database. The stored catalog is trusted for `catalog_ttl` seconds after
+        the last check, then its version is compared with the version marker of
+        the database. When the database can not be reached, the last stored catalog is used.
+        :param key: name of the part; countries, years or indicators
+        :type key: str
+        :param fetch: function that gets the part from the database
+        :type fetch: callable
+        :return: list of catalog entries
+        """
+        if self.catalog_cache is None:
+            return fetch()
+
+        with self.catalog_lock:
+            if self.stored_catalog is None:
+                stored = self.catalog_cache.load() or CatalogCache.empty()
+                if time.time() - stored["checked"] > self.catalog_ttl:
+                    version = self.data_version()
+                    if version is not None:
+                        if version != stored["version"]:
+                            stored = CatalogCache.empty(version)
+                        stored["checked"] = time.time()
+                        self.catalog_cache.save(stored)
+                self.stored_catalog = stored
+
+            parts = self.stored_catalog["parts"]
+            if key not in parts:
+                parts[key] = fetch()
+                self.catalog_cache.save(self.stored_catalog)
+            return parts[key]
+
     def countries(self):
         """ Function gets data from local database.
         :return: list of countries with country codes and names
         """
-        if self.countries_cache is not None:
-            return self.countries_cache
+        if self.countries_cache is None:
+            self.countries_cache = self.catalog("countries", self.fetch_countries)
+        return self.countries_cache
 
+    def fetch_countries(self):
         cursor = self.db.countries.find({}, {'_id': 1, 'name': 1})
         out = []
         for doc in cursor:
             out.append((doc['_id'], doc['name']))
-        self.countries_cache = out
         return out
 
     def years(self):
         """ Function gets data from local database.
         :return: list of years with data
         """
-        if self.years_cache is not None:
-            return self.years_cache
-        # sTime = time.time_ns()
-        cursor = self.db.countries.find({"_id": {"$in": ["SVN"]}}, {"indicators": 1})
-        years = [year for doc in cursor for _, val in doc['indicators'].items() for year in val.keys()]
-        years = set(years)
-        # print("Time to get years:", (time.time_ns() - sTime) / (10 ** 9))
-        self.years_cache = sorted(list(years), reverse=True)
+        if self.years_cache is None:
+            self.years_cache = self.catalog("years", self.fetch_years)
+        return self.years_cache
+
+    def fetch_years(self):
+        doc = self.db.metadata.find_one({"_id": "years"}, {"years": 1})
+        if doc is not None:
+            years = set(doc['years'])
+        else:
+            # Database without metadata document, derive years from a single country
+            cursor = self.db.countries.find({"_id": {"$in": ["SVN"]}}, {"indicators": 1})
+            years = {year for doc in cursor for _, val in doc['indicators'].items() for year in val.keys()}
         return sorted(list(years), reverse=True)
 
+    def year_coverage(self, indicators):
+        """ Function gets years with data of indicators from local database.
+        :param indicators: list of indicator codes
+        :type indicators: list
+        :return: dict of sorted lists of years keyed by indicator code
+        """
+        codes = {i: str.replace(i, '.', '_') for i in indicators}
+        doc = self.db.metadata.find_one({"_id": "years"}, {f"coverage.{code}": 1 for code in codes.values()})
+        coverage = doc.get('coverage', {}) if doc is not None else {}
+        return {i: coverage.get(code, []) for i, code in codes.items()}
+
+    def refresh_metadata(self):
+        """ Recomputes the metadata document with years of all indicators and the
+        global range of years. Called by update().
+        """
+        pipeline = [
+            {'$project': {'series': {'$objectToArray': '$indicators'}}},
+            {'$unwind': '$series'},
+            {'$project': {
+                'code': '$series.k',
+                'years': {'$map': {'input': {'$objectToArray': '$series.v'}, 'as': 'kv', 'in': '$$kv.k'}}
+            }},
+            {'$unwind': '$years'},
+            {'$group': {'_id': '$code', 'years': {'$addToSet': '$years'}}},
+        ]
+        coverage = {doc['_id']: sorted(doc['years']) for doc in self.db.countries.aggregate(pipeline)}
+        years = sorted({year for code_years in coverage.values() for year in code_years})
+        self.db.metadata.replace_one(
+            {"_id": "years"}, {"_id": "years", "years": years, "coverage": coverage}, upsert=True
+        )
+
     def indicators(self):
         """ Function gets data from local database.
         Indicator is of form (db, code, is_relative, desc) possibly with url explanation.
         :return: list of indicators
         """
-        if self.indicators_cache is not None:
-            return self.indicators_cache
+        if self.indicators_cache is None:
+            self.indicators_cache = self.catalog("indicators", self.fetch_indicators)
+        return self.indicators_cache
+
+    def fetch_indicators(self):
         cursor = self.db.indicators.find({})
-        out = []
-        for doc in cursor:
-            indic = [
-                doc['db'],
-                str.replace(doc['_id'], '_', '.'),
-                doc['desc'],
-                doc['code_exp'] if 'code_exp' in doc else [],
-                doc['is_relative'] if 'is_relative' in doc else '',
-                doc['url'] if 'url' in doc else '',
-                doc['sparse_indicator']
-            ]
-            out.append(tuple(indic))
-        self.indicators_cache = out
-        return out
+        return [indicator_from_doc(doc) for doc in cursor]
+
+    def refresh_pre_aggregates(self):
+        """ Recomputes aggregates of series over windows of latest years, one field for
+        each method and window. Aggregates are built into a new collection that is
+        published together with its windows by the metadata document "aggregates", so
+        readers never see a partially built collection. The collection of the previous
+        build is kept for clients that still read it, older ones are dropped.
+        Called by update() after refresh_metadata().
+        """
+        from bson import ObjectId
+
+        doc = self.db.metadata.find_one({"_id": "years"}, {"years": 1})
+        latest = max(int(year) for year in doc['years']) if doc is not None and doc['years'] else None
+        codes = [ind['_id'] for ind in self.db.indicators.find({}, {'_id': 1})]
+        collection = f"aggregates_{ObjectId()}"
+
+        windows = {}
+        try:
+            for n in PRE_AGGREGATE_WINDOWS if latest is not None else ():
+                years = list(range(latest - n + 1, latest + 1))
+                for method in SERVER_AGGREGATIONS:
+                    if not self.server_aggregation(method):
+                        continue
+                    key = f"{method}_{n}"
+                    # Aggregates are merged into documents of countries on the server, a batch of indicators
+                    # at a time to keep pipelines small
+                    for i in range(0, len(codes), PRE_AGGREGATE_BATCH_SIZE):
+                        batch = codes[i:i + PRE_AGGREGATE_BATCH_SIZE]
+                        self.db.countries.aggregate([
+                            {'$project': {'name': 1, key: aggregate_projection(batch, years, method)['values']}},
+                            {'$merge': {'into': collection, 'whenMatched': [
+                                {'$set': {'name': '$$new.name', key: {'$mergeObjects': [f'${key}', f'$$new.{key}']}}}
+                            ]}}
+                        ])
+                    windows[key] = {"method": method, "years": [str(y) for y in years]}
+        except BaseException:
+            self.db.drop_collection(collection)
+            raise
+
+        old = self.db.metadata.find_one({"_id": "aggregates"})
+        previous = old.get("collection", "aggregates") if old is not None else None
+        self.db.metadata.replace_one(
+            {"_id": "aggregates"},
+            {"_id": "aggregates", "collection": collection, "previous": previous, "windows": windows},
+            upsert=True
+        )
+        if old is not None and old.get("previous"):
+            self.db.drop_collection(old["previous"])
+
+    def pre_aggregate(self, year, method):
+        """ Finds aggregates of given years stored by refresh_pre_aggregates().
+        :param year: list of years
+        :type year: list
+        :param method: name of aggregation
+        :type method: str
+        :return: names of the collection and of the field with aggregates or None
+        """
+        years = sorted({str(y) for y in year})
+        if len(years) not in PRE_AGGREGATE_WINDOWS:
+            return None
+        # Windows are read once for each version of database, their collection is
+        # never modified after it is published
+        if self.pre_aggregates_cache is None or self.pre_aggregates_cache[0] != self.data_version_cache:
+            doc = self.db.metadata.find_one({"_id": "aggregates"})
+            with self.stats_lock:
+                self.last_query_stats["round_trips"] += 1
+            self.pre_aggregates_cache = (self.data_version_cache, doc or {})
+        doc = self.pre_aggregates_cache[1]
+        for key, window in doc.get('windows', {}).items():
+            if window['method'] == method and sorted(window['years']) == years:
+                return doc.get('collection', "aggregates"), key
+        return None
+
+    def find_countries(self, countries, projection, batch_size=QUERY_BATCH_SIZE, collection="countries"):
+        """ Fetch country documents with one `$in` query per chunk of countries.
+        Every issued query is counted in `last_query_stats["round_trips"]` and
+        the size of received documents in `last_query_stats["bytes_received"]`.
+        :param countries: list of country codes
+        :type countries: list
+        :param projection: `$project` stage applied to country documents
+        :type projection: dict
+        :param batch_size: number of countries per query
+        :type batch_size: int
+        :param collection: name of collection with documents of countries
+        :type collection: str
+        :return: generator of country documents
+        """
+        import bson
+
+        collection = self.db[collection]
+        for i in range(0, len(countries), batch_size):
+            chunk = countries[i:i + batch_size]
+            pipeline = [{"$match": {"_id": {"$in": chunk}}}, {"$project": projection}]
+            # Request the whole chunk in the first reply to avoid additional getMore round trips
+            cursor = collection.aggregate(pipeline, batchSize=len(chunk))
+            with self.stats_lock:
+                self.last_query_stats["round_trips"] += 1
+            for doc in cursor:
+                with self.stats_lock:
+                    self.last_query_stats["bytes_received"] += len(bson.encode(doc))
+                yield doc
+
+    def data_version(self):
+        """ Reads the version marker of the database written by update().
+        :return: version string or None if the database can not be reached
+        """
+        from pymongo import timeout
+        from pymongo.errors import PyMongoError
+
+        try:
+            with timeout(VERSION_TIMEOUT):
+                doc = self.db.metadata.find_one({"_id": "version"})
+        except PyMongoError:
+            return None
+        with self.stats_lock:
+            self.last_query_stats["round_trips"] += 1
+        return str(doc["modified"]) if doc else ""
+
+    def validate_caches(self):
+        """ Drops cached series if the database was updated since they were fetched.
+        :return: version of the database the cached series belong to, None if it was never reached
+        """
+        version = self.data_version()
+        if version is not None and version != self.data_version_cache:
+            self.data_version_cache = version
+            if self.memory_cache is not None:
+                self.memory_cache.clear()
+        if self.disk_cache is not None:
+            self.disk_cache.validate(version)
+        return self.data_version_cache
+
+    def cached_series(self, countries, codes, year):
+        """ Gets indicator series of countries from the memory and disk cache without
+        querying the database. Returned series may not cover given years.
+        Caches should be validated with validate_caches() before the call.
+        :param countries: list of country codes
+        :type countries: list
+        :param codes: list of indicator codes with underscores
+        :type codes: list
+        :param year: list of years
+        :type year: list
+        :return: dict of country names and dict of Series keyed by (country, code)
+        """
+        years = frozenset(str(y) for y in year)
+
+        def covered(country, code):
+            return (country, code) in series and series[(country, code)].covers(years)
+
+        names, series = {}, {}
+        if self.memory_cache is not None:
+            names, series = self.memory_cache.get(countries, codes, years)
+
+        missing = [c for c in countries if c not in names or not all(covered(c, code) for code in codes)]
+        if missing and self.disk_cache is not None:
+            disk_names, disk_series = self.disk_cache.get(missing, codes)
+            names.update(disk_names)
+            series.update((key, s) for key, s in disk_series.items() if not covered(*key))
+            if self.memory_cache is not None:
+                self.memory_cache.put(disk_names, disk_series)
+        return names, series
+
+    def fetch_series(self, countries, codes, year, batch_size=QUERY_BATCH_SIZE, callback=dummy_callback):
+        """ Gets indicator series of countries restricted to given years. Series are
+        served from the memory or disk cache when possible and fetched from the database otherwise.
+        Caches should be validated with validate_caches() before the call.
+        :param countries: list of country codes
+        :type countries: list
+        :param codes: list of indicator codes with underscores
+        :type codes: list
+        :param year: list of years
+        :type year: list
+        :param batch_size: number of countries fetched with a single query
+        :param callback: callback function
+        :return: dict of country names and dict of Series keyed by (country, code)
+        """
+        years = frozenset(str(y) for y in year)
+
+        def covered(country, code):
+            return (country, code) in series and series[(country, code)].covers(years)
+
+        names, series = self.cached_series(countries, codes, year)
+        missing = [c for c in countries if c not in names or not all(covered(c, code) for code in codes)]
+        if not missing:
+            return names, series
+        missing_codes = [code for code in codes if not all(covered(c, code) for c in missing)]
+
+        # Only requested years and the last available year of each series are downloaded
+        projection = series_projection(missing_codes, year)
+        fetched_names, fetched = {}, {}
+        for step, doc in enumerate(self.find_countries(missing, projection, batch_size), 1):
+            country = doc['_id']
+            fetched_names[country] = doc['name']
+            for code, country_series in decode_series(doc, missing_codes, years).items():
+                if (country, code) in series:
+                    country_series = series[(country, code)].merge(country_series)
+                fetched[(country, code)] = country_series
+            callback(step / len(missing) * 0.8, "Fetching data ...")
+
+        if self.disk_cache is not None:
+            self.disk_cache.put(fetched_names, fetched)
+        if self.memory_cache is not None:
+            self.memory_cache.put(fetched_names, fetched)
+        names.update(fetched_names)
+        series.update(fetched)
+        return names, series
+
+    def projection_savings(self, countries, indicators, year):
+        """ Measures the size of country documents with full indicator series and
+        with series projected to requested years.
+        :param countries: list of country codes
+        :type countries: list
+        :param indicators: list of indicator codes
+        :type indicators: list
+        :param year: year for data
+        :type year: list(int) or int
+        :return: dict with number of bytes for "full" and "projected" documents
+        """
+        import bson
+
+        if type(year) is int:
+            year = [year]
+        codes = [str.replace(i, '.', '_') for i in indicators]
+
+        query_filter = {'_id': 1, 'name': 1}
+        for code in codes:
+            query_filter[f'indicators.{code}'] = 1
+        cursor = self.db.countries.find({"_id": {"$in": list(countries)}}, query_filter)
+        full = sum(len(bson.encode(doc)) for doc in cursor)
+
+        self.last_query_stats = {"round_trips": 0, "bytes_received": 0}
+        list(self.find_countries(list(countries), series_projection(codes, year)))
+        return {"full": full, "projected": self.last_query_stats["bytes_received"]}
+
+    def server_aggregation(self, method):
+        """ Can the database aggregate years of series with the method.
+        :param method: name of aggregation; mean, median, min or max
+        :type method: str
+        :return: bool
+        """
+        if method not in SERVER_AGGREGATIONS:
+            return False
+        if self.server_version_cache is None:
+            self.server_version_cache = tuple(self.db.client.server_info()["versionArray"][:2])
+        return self.server_version_cache >= SERVER_AGGREGATIONS[method]
+
+    def fetch_aggregates(self, countries, codes, year, method, batch_size=QUERY_BATCH_SIZE, callback=dummy_callback):
+        """ Gets values of indicators aggregated over years by the database, a single
+        number per country and indicator is downloaded. Aggregates are read from the
+        collection of stored aggregates when it holds the requested years, otherwise they are
+        computed from series. Aggregates are not cached.
+        :param countries: list of country codes
+        :type countries: list
+        :param codes: list of indicator codes with underscores
+        :type codes: list
+        :param year: list of years
+        :type year: list
+        :param method: name of aggregation supported by server_aggregation()
+        :type method: str
+        :param batch_size: number of countries fetched with a single query
+        :param callback: callback function
+        :return: array of country names and array of values with a row for each country
+        """
+        values = np.full((len(countries), len(codes)), np.nan)
+        names = np.full(len(countries), str(np.nan), dtype=object)
+        rows = {country: row for row, country in enumerate(countries)}
+
+        self.last_query_stats = {"round_trips": 0, "bytes_received": 0}
+        stored = self.pre_aggregate(year, method)
+        if stored is not None:
+            collection, key = stored
+            projection = {'_id': 1, 'name': 1, 'values': {code: f'${key}.{code}' for code in codes}}
+        else:
+            collection = "countries"
+            projection = aggregate_projection(codes, year, method)
+        for step, doc in enumerate(self.find_countries(countries, projection, batch_size, collection), 1):
+            row = rows[doc['_id']]
+            names[row] = doc['name']
+            for col, code in enumerate(codes):
+                value = doc['values'].get(code)
+                if value is not None:
+                    values[row, col] = value
+            callback(step / len(countries) * 0.8, "Fetching data ...")
+        return names, values
+
+    def aggregated_data(self, countries, indicators, year, method, include_country_names=True,
+                        callback=dummy_callback, index_freq=0, country_freq=0, batch_size=QUERY_BATCH_SIZE):
+        """ Function gets data aggregated over years by the database.
+        :param batch_size: number of countries fetched with a single query
+        :param country_freq: percentage of not NaN values to keep country
+        :param index_freq: percentage of not NaN values to keep indicator
+        :param callback: callback function
+        :param include_country_names: add collumn with country names
+        :param countries: list of country codes
+        :type countries: list
+        :param indicators: list of indicator codes
+        :type indicators: list
+        :param year: years for data
+        :type year: list(int) or int
+        :param method: name of aggregation supported by server_aggregation()
+        :type method: str
+        :return: Pandas dataframe with a column for each indicator
+        """
+        if type(year) is int:
+            year = [year]
+        countries = list(countries)
+        codes = [str.replace(i, '.', '_') for i in indicators]
+
+        callback(0, "Fetching data ...")
+        self.validate_caches()
+        names, values = self.fetch_aggregates(countries, codes, year, method, batch_size, callback)
+        return sparse_frame(countries, list(indicators), values, names, index_freq, country_freq,
+                            include_country_names)
 
     def data(self, countries, indicators, year, include_country_names=True, callback=dummy_callback, index_freq=0,
-             country_freq=0):
+             country_freq=0, batch_size=QUERY_BATCH_SIZE, max_workers=1, aggregation=None):
         """ Function gets data from local database.
+        :param aggregation: name of aggregation of years supported by server_aggregation(),
+            see aggregated_data(); None for a column of each year
+        :param max_workers: number of threads fetching shards of countries in parallel
+        :param batch_size: number of countries fetched with a single query
         :param country_freq: percentage of not NaN values to keep country
         :param index_freq: percentage of not NaN values to keep indicator
         :param callback: callback function
@@ -131,77 +900,111 @@ class WorldIndicators:
 
         if type(year) is int:
             year = [year]
+        if aggregation is not None and len(year) > 1:
+            return self.aggregated_data(countries, indicators, year, aggregation, include_country_names, callback,
+                                        index_freq, country_freq, batch_size)
+        countries = list(countries)
+        codes = [str.replace(i, '.', '_') for i in indicators]
 
-        cols = ["Country name"] if include_country_names else []
+        callback(0, "Fetching data ...")
 
-        if len(year) > 1:
-            for i in indicators:
-                for y in year:
-                    cols.append(f"{y}-{i}")
+        self.last_query_stats = {"round_trips": 0, "bytes_received": 0}
+        self.validate_caches()
+        if max_workers > 1:
+            cols, values, names = self._parallel_values(countries, indicators, year, callback, batch_size,
+                                                        max_workers)
         else:
-            for i in indicators:
-                cols.append(i)
-
-        # Create appropriate pandas Dataframe
-        df = pd.DataFrame(data=None, index=countries, columns=cols, dtype=float)
-        df.index.name = "Country code"
-
-        # Add country name column
-        if include_country_names:
-            df = df.astype({"Country name": str})
-
-        steps = len(countries) * len(indicators)
-        step = 1
+            country_names, series = self.fetch_series(countries, codes, year, batch_size=batch_size,
+                                                      callback=callback)
+            cols, values, names = series_values(countries, indicators, year, country_names, series)
+        return sparse_frame(countries, cols, values, names, index_freq, country_freq, include_country_names)
+
+    def _parallel_values(self, countries, indicators, year, callback, batch_size, max_workers):
+        """ Fetches shards of countries in a thread pool. Each thread fills its own
+        block of rows of shared value arrays.
+        :return: list of column names, float array of values and object array of country names
+        """
+        cols, layout = frame_layout(indicators, year)
+        codes = [code for _, code, _ in layout]
+        values = np.full((len(countries), len(cols)), np.nan)
+        names = np.full(len(countries), str(np.nan), dtype=object)
+
+        shard_size = max(1, min(batch_size, -(-len(countries) // max_workers)))
+        shards = [slice(i, i + shard_size) for i in range(0, len(countries), shard_size)]
+
+        def fetch_shard(rows):
+            country_names, series = self.fetch_series(countries[rows], codes, year, batch_size=batch_size)
+            return fill_rows(values[rows], names[rows], countries[rows], layout, country_names, series)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {executor.submit(fetch_shard, rows): rows for rows in shards}
+        try:
+            # Progress is reported from the calling thread which can also interrupt the query
+            for step, future in enumerate(as_completed(futures), 1):
+                future.result()
+                callback(step / len(shards) * 0.8, "Fetching data ...")
+        finally:
+            # Shards that have not started are dropped when the query fails or is interrupted
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        # Merge columns of last available years in order of shards
+        last_year_cols = {}
+        for future, rows in futures.items():
+            for name, column in future.result().items():
+                if name not in last_year_cols:
+                    last_year_cols[name] = np.full(len(countries), np.nan)
+                last_year_cols[name][rows] = column
+        cols, values = stack_last_years(cols, values, last_year_cols)
+        return cols, values, names
+
+    def iter_series(self, countries, codes, year, callback=dummy_callback, batch_size=QUERY_BATCH_SIZE):
+        """ Function gets indicator series from local database in blocks of countries as they arrive.
+        :param batch_size: number of countries in a block
+        :param callback: callback function
+        :param countries: list of country codes
+        :type countries: list
+        :param codes: list of indicator codes with underscores
+        :type codes: list
+        :param year: year for data
+        :type year: list(int) or int
+        :return: generator of (block of countries, dict of country names, dict of Series keyed by (country, code))
+        """
+        if type(year) is int:
+            year = [year]
+        countries = list(countries)
 
         callback(0, "Fetching data ...")
 
-        query_filter = {'_id': 1, 'name': 1}
-        for i in indicators:
-            code = str.replace(i, '.', '_')
-            query_filter[f'indicators.{code}'] = 1
-
-        # Fill Dataframe from local database
-
-        collection = self.db.countries
-        for country in countries:
-            doc = collection.find_one({"_id": country}, query_filter)
-            if include_country_names:
-                df.at[doc['_id'], "Country name"] = doc['name']
-            for i in indicators:
-                # Must change indicator code to underscores because of Mongo naming restrictions
-                code = str.replace(i, '.', '_')
-                get_last_available_year = True
-                if code in doc['indicators']:
-                    values = doc['indicators'][code]
-                    if len(year) > 1:
-                        for y in year:
-                            if str(y) in values:
-                                df.at[doc['_id'], f"{y}-{i}"] = values[str(y)]
-                                get_last_available_year = False
-                    else:
-                        if str(year[0]) in values:
-                            df.at[doc['_id'], i] = values[str(year[0])]
-                            get_last_available_year = False
-
-                    if get_last_available_year and len(values) > 0:
-                        last_year = list(values.keys())[-1]
-                        name = i
-                        if type(year) is list:
-                            name = f"{last_year}-{i}"
-                        df.at[doc['_id'], name] = values[str(last_year)]
-
-                callback(step / steps * 0.8, "Fetching data ...")
-                step += 1
-
-        # Remove indicator based on percantage of NaN countries
-        min_count = max(len(countries) * index_freq * 0.01, 1)
-        df = df.dropna(thresh=min_count, axis=1)
-
-        # Remove country based on percentage of NaN indicators                                                      
-        min_count = max(len(df.columns) * country_freq * 0.01, 1)
-        df = df.dropna(thresh=min_count, axis=0)
-
-        return df
+        self.last_query_stats = {"round_trips": 0, "bytes_received": 0}
+        self.validate_caches()
+        for i in range(0, len(countries), batch_size):
+            chunk = countries[i:i + batch_size]
+            country_names, series = self.fetch_series(chunk, codes, year, batch_size=batch_size)
+            callback(min(i + batch_size, len(countries)) / len(countries) * 0.8, "Fetching data ...")
+            yield chunk, country_names, series
+
+    def iter_data(self, countries, indicators, year, include_country_names=True, callback=dummy_callback,
+                  batch_size=QUERY_BATCH_SIZE):
+        """ Function gets data from local database in blocks of countries as they arrive.
+        Unlike data() it does not remove sparse indicators and countries.
+        :param batch_size: number of countries in a block
+        :param callback: callback function
+        :param include_country_names: add collumn with country names
+        :param countries: list of country codes
+        :type countries: list
+        :param indicators: list of indicator codes
+        :type indicators: list
+        :param year: year for data
+        :type year: list(int) or int
+        :return: generator of Pandas dataframes
+        """
+        if type(year) is int:
+            year = [year]
+        codes = [str.replace(i, '.', '_') for i in indicators]
+        for chunk, country_names, series in self.iter_series(countries, codes, year, callback, batch_size):
+            yield series_frame(chunk, indicators, year, country_names, series, include_country_names)
 
     def update(self, countries, indicators, years, db):
         """ Refreshes the local database from a given db database.
@@ -216,6 +1019,9 @@ class WorldIndicators:
         :return: list of indicators
         """
 
+        import wbgapi as wb
+        from requests import HTTPError
+
         if type(years) is int:
             years = [years]
 
@@ -468,6 +1274,19 @@ class WorldIndicators:
 
             print("FINISHED")
 
+        self.refresh_metadata()
+        self.refresh_pre_aggregates()
+
+        # New version marker invalidates local caches of clients
+        self.db.metadata.replace_one(
+            {"_id": "version"}, {"_id": "version", "modified": datetime.datetime.now()}, upsert=True
+        )
+        self.countries_cache = self.years_cache = self.indicators_cache = None
+        self.stored_catalog = None
+        self.pre_aggregates_cache = None
+        if self.catalog_cache is not None:
+            self.catalog_cache.save(CatalogCache.empty())
+
 
 if __name__ == "__main__":
     print("Blank")
@@ -1,29 +1,46 @@
-from typing import Any, Set, Optional
+from collections import defaultdict
+from typing import Any, Dict, Set, Optional, Tuple, NamedTuple
+
+import numpy as np
 
 from AnyQt.QtCore import Qt, Signal, QSortFilterProxyModel, QItemSelection, QItemSelectionModel, \
-    QModelIndex, QMimeData
+    QModelIndex, QMimeData, QTimer
 from AnyQt.QtWidgets import QLineEdit, \
     QTableView, QListView, QTreeWidget, QTreeWidgetItem, QAbstractItemView, QCheckBox, QSplitter, QVBoxLayout, \
     QApplication
 from AnyQt.QtGui import QDrag, QClipboard
 
 from Orange.widgets.settings import Setting
-from Orange.widgets.utils.concurrent import ConcurrentWidgetMixin, TaskState
-from Orange.widgets.utils.itemmodels import PyTableModel
-from Orange.widgets.utils.listfilter import (
-    slices, delslice
-)
+from Orange.widgets.utils.concurrent import ConcurrentWidgetMixin, TaskState, ThreadExecutor, FutureWatcher
+from Orange.widgets.utils.itemmodels import AbstractSortTableModel
 from Orange.widgets.utils.tableview import table_selection_to_mime_data
-from Orange.widgets.widget import OWWidget, Output, Input
+from Orange.widgets.widget import OWWidget, Output, Input, Msg
 from Orange.widgets import gui
+from Orange.util import dummy_callback
 
 from orangecontrib.worldhappiness.whstudy import *
+from orangecontrib.worldhappiness.whstudy.world_data_api import FetchedSeries, indicator_code, series_values, \
+    sparse_masks
 
-MONGO_HANDLE = WorldIndicators('main', 'biolab')
+_MONGO_HANDLE = None
 EXP_NAMES = ['Topic', 'General Subject', 'Specific subject', 'Extension', 'Extension', 'Extension']
 DB_NAMES = [('WDI', 'World Data Indicators'),
             ('WHR', 'World Happiness Report'),
             ('HSL_OECD', 'How\'s life \r\nOrganization for Economic Co-operation and Development')]
+# Milliseconds of typing pause before the indicator filter is applied
+FILTER_DELAY = 150
+# Number of filter words whose matching tokens are remembered
+RECENT_WORDS = 32
+
+
+def mongo_handle() -> WorldIndicators:
+    """ Return the shared handle of the remote database. It is created on first
+    use so that discovering the add-on does not set up a connection.
+    """
+    global _MONGO_HANDLE
+    if _MONGO_HANDLE is None:
+        _MONGO_HANDLE = WorldIndicators('main', 'biolab')
+    return _MONGO_HANDLE
 
 
 def source_model(view):
@@ -46,17 +63,194 @@ def source_indexes(indexes, view):
         return indexes
 
 
+def selected_view_rows(view) -> List[int]:
+    """ Rows of the view's model with selected items. Selection ranges are read
+    directly, QItemSelectionModel.selectedRows slows down quadratically with
+    the number of disjoint ranges.
+    """
+    rows = set()
+    for selection_range in view.selectionModel().selection():
+        rows.update(range(selection_range.top(), selection_range.bottom() + 1))
+    return sorted(rows)
+
+
+def index_indicators(indicators: List) -> Dict[str, List]:
+    """ Indicators grouped by their code, the same code can appear in several sources.
+    """
+    by_code = defaultdict(list)
+    for ind in indicators:
+        by_code[ind[1]].append(ind)
+    return dict(by_code)
+
+
+def describe_columns(cols: List[str], by_code: Dict[str, List]) -> Dict[str, Dict]:
+    """ Attributes with descriptions of indicators of columns, keyed by column name.
+    """
+    described = {}
+    for code in {indicator_code(name) for name in cols} & by_code.keys():
+        (db, code, desc, ind_exp, is_rel, url, *_) = by_code[code][-1]
+        described[code] = {"Description": desc}
+        if len(ind_exp) > 0:
+            split = code.split(".")
+            for i in range(len(ind_exp)):
+                described[code][EXP_NAMES[min(i, len(EXP_NAMES)-1)]] = f"{split[i]} - {ind_exp[i]}"
+    return {name: described[indicator_code(name)] for name in cols if indicator_code(name) in described}
+
+
+def indicator_key(row) -> Tuple[str, str]:
+    return row[0], row[1]
+
+
+class IndicatorSearchIndex:
+    """ Lowercase haystacks of source, code and description of indicators with
+    an inverted index of their whitespace separated tokens. Filter words contain
+    no whitespace, so a word occurs in a haystack exactly when it occurs in one
+    of its tokens and only the vocabulary has to be scanned.
+    """
+
+    def __init__(self, indicators: List):
+        self.haystacks = {}
+        self.postings = defaultdict(set)
+        self.relative = set()
+        self.sparse = set()
+        self._recent_tokens = {}
+        for row in indicators:
+            key = indicator_key(row)
+            haystack = f"{row[0]} {row[1]} {row[2]}".lower()
+            self.haystacks[key] = haystack
+            for token in haystack.split():
+                self.postings[token].add(key)
+            if row[4]:
+                self.relative.add(key)
+            if row[6]:
+                self.sparse.add(key)
+
+    def find(self, word: str) -> Set[Tuple[str, str]]:
+        """ Keys of indicators containing the lowercase word. Tokens matching
+        recent words are remembered, so extending a word scans only them.
+        """
+        tokens = self.postings
+        for prev, prev_tokens in self._recent_tokens.items():
+            if prev in word and len(prev_tokens) < len(tokens):
+                tokens = prev_tokens
+        tokens = [token for token in tokens if word in token]
+        if len(self._recent_tokens) >= RECENT_WORDS:
+            self._recent_tokens.clear()
+        self._recent_tokens[word] = tokens
+
+        keys = set()
+        for token in tokens:
+            keys |= self.postings[token]
+        return keys
+
+    def search(self, words: List[str], and_filter: bool) -> Set[Tuple[str, str]]:
+        """ Keys of indicators containing all (and_filter) or any of the words.
+        """
+        found = [self.find(word) for word in dict.fromkeys(words)]
+        if and_filter:
+            return set.intersection(*sorted(found, key=len))
+        return set.union(*found)
+
+    def refine(self, keys: Set, words: List[str], and_filter: bool) -> Set[Tuple[str, str]]:
+        """ Subset of keys of indicators containing all (and_filter) or any of the words.
+        """
+        match = all if and_filter else any
+        return {key for key in keys if match(word in self.haystacks[key] for word in words)}
+
+
+def narrows(old_words: List[str], new_words: List[str], and_filter: bool) -> bool:
+    """ Is every match of new words also a match of old words. In All mode each
+    old word must be a part of some new word, in Any mode each new word must
+    contain some old word.
+    """
+    if not old_words or not new_words:
+        return False
+    if and_filter:
+        return all(any(old in new for new in new_words) for old in old_words)
+    return all(any(old in new for old in old_words) for new in new_words)
+
+
+class Catalog(NamedTuple):
+    years: List
+    countries: List
+    indicators: List
+    search_index: IndicatorSearchIndex
+    by_code: Dict[str, List]
+
+
+def load_catalog() -> Catalog:
+    handle = mongo_handle()
+    indicators = handle.indicators()
+    return Catalog(handle.years(), handle.countries(), indicators, IndicatorSearchIndex(indicators),
+                   index_indicators(indicators))
+
+
+def local_aggregates(
+        countries: List,
+        indicator_codes: List,
+        years: List,
+        agg_method: int,
+        fetched: FetchedSeries
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Names of countries and values of indicators aggregated over years from fetched
+    series, a column for each indicator as in WorldIndicators.fetch_aggregates.
+    """
+    cols, values, names = series_values(countries, indicator_codes, years, fetched.names, fetched.series)
+    _, _, cube = year_cube(cols, values, indicator_codes)
+    return names, AggregationMethods.aggregate_cube(cube, agg_method)
+
+
+def server_aggregates(
+        countries: List,
+        indicator_codes: List,
+        years: List,
+        agg_method: int,
+        fetched: FetchedSeries,
+        fetch_countries: List,
+        callback
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """ Names of countries and values of indicators aggregated over years by the database
+    for fetch_countries and from fetched series for other countries. None when the database
+    can not aggregate them, series are then fetched and aggregated locally.
+    """
+    from pymongo.errors import PyMongoError
+
+    handle = mongo_handle()
+    method = AggregationMethods.SERVER_NAMES[agg_method]
+    codes = [str.replace(code, '.', '_') for code in indicator_codes]
+    try:
+        if not handle.server_aggregation(method):
+            return None
+        fetched_names, fetched_values = handle.fetch_aggregates(fetch_countries, codes, years, method,
+                                                                callback=callback)
+    except PyMongoError:
+        return None
+
+    is_fetched = np.isin(countries, fetch_countries)
+    names = np.full(len(countries), str(np.nan), dtype=object)
+    values = np.full((len(countries), len(codes)), np.nan)
+    names[is_fetched], values[is_fetched] = fetched_names, fetched_values
+    if not is_fetched.all():
+        names[~is_fetched], values[~is_fetched] = local_aggregates(
+            [country for country, f in zip(countries, is_fetched) if not f], indicator_codes, years, agg_method,
+            fetched
+        )
+    return names, values
+
+
 def run(
         countries: List,
         indicators: List,
         years: List,
         agg_method: int,
+        statistics: List,
         index_freq: int,
         country_freq: int,
+        fetched: Optional[FetchedSeries],
         state: TaskState
-) -> Table:
+) -> Tuple[Optional[Table], Optional[FetchedSeries]]:
     if not countries or not indicators or not years:
-        return None
+        return None, fetched
 
     # Define progress callback
     def callback(i: float, status=""):
@@ -67,27 +261,70 @@ def run(
             raise Exception
 
     indicator_codes = [code for (_, code, desc, *other) in indicators]
-
+    codes = [str.replace(code, '.', '_') for code in indicator_codes]
+    by_code = index_indicators(indicators)
     is_agg_none = agg_method == AggregationMethods.NONE
-    main_df = MONGO_HANDLE.data(countries, indicator_codes, years, callback=callback,
-                                index_freq=index_freq if is_agg_none else 0,
-                                country_freq=country_freq if is_agg_none else 0)
-
-    results = table_from_frame(main_df)
-    results = AggregationMethods.aggregate(results, agg_method=agg_method if len(years) > 1 else 0,
-                                           index_freq=index_freq, country_freq=country_freq, callback=callback)
-
-    # Add descriptions to indicators
-    if results:
-        for attrib in results.domain.attributes:
-            for (db, code, desc, ind_exp, is_rel, url, *_) in indicators:
-                if code in attrib.name:
-                    attrib.attributes["Description"] = desc
-                    if len(ind_exp) > 0:
-                        split = code.split(".")
-                        for i in range(len(ind_exp)):
-                            attrib.attributes[EXP_NAMES[min(i, len(EXP_NAMES)-1)]] = f"{split[i]} - {ind_exp[i]}"
-    return results
+    agg_method = agg_method if len(years) > 1 else AggregationMethods.NONE
+
+    # Fetch only series missing from the previous result, unless the database was updated since
+    handle = mongo_handle()
+    version = handle.validate_caches()
+    if fetched is None or fetched.version != version:
+        fetched = FetchedSeries({}, {}, version)
+    streaming = not fetched.series
+    fetch_countries, fetch_codes, fetch_years = fetched.missing(countries, codes, years)
+
+    # Series that are not cached are aggregated by the database, only the aggregates are downloaded
+    method = AggregationMethods.SERVER_NAMES.get(agg_method)
+    if fetch_countries and method is not None:
+        fetched = fetched.merge(*handle.cached_series(fetch_countries, fetch_codes, fetch_years))
+        fetch_countries, fetch_codes, fetch_years = fetched.missing(countries, codes, years)
+        if fetch_countries:
+            aggregates = server_aggregates(countries, indicator_codes, years, agg_method, fetched, fetch_countries,
+                                           callback)
+            if aggregates is not None:
+                names, values = aggregates
+                results = AggregationMethods.aggregated_table(countries, names, indicator_codes, values,
+                                                              index_freq=index_freq, country_freq=country_freq,
+                                                              attributes=describe_columns(indicator_codes, by_code))
+                return results, fetched.restrict(countries, codes)
+
+    if fetch_countries:
+        done = []
+        for chunk, names, series in mongo_handle().iter_series(fetch_countries, fetch_codes, fetch_years,
+                                                              callback=callback):
+            fetched = fetched.merge(names, series)
+            done.extend(chunk)
+            # Send growing tables while blocks of countries arrive
+            if streaming and len(done) < len(countries):
+                cols, values, names = series_values(done, indicator_codes, years, fetched.names, fetched.series)
+                if agg_method == AggregationMethods.NONE:
+                    partial = world_table(done, names, cols, values, describe_columns(cols, by_code))
+                else:
+                    partial = AggregationMethods.aggregate_values(done, names, cols, values, agg_method,
+                                                                  dummy_callback, index_freq=0, country_freq=0,
+                                                                  statistics=statistics,
+                                                                  attributes=describe_columns(cols, by_code),
+                                                                  codes=indicator_codes)
+                state.set_partial_result(partial)
+    fetched = fetched.restrict(countries, codes)
+
+    # Sparse columns and countries are dropped from the decoded array before any variable is made
+    cols, values, names = series_values(countries, indicator_codes, years, fetched.names, fetched.series)
+    if agg_method == AggregationMethods.NONE:
+        return sparse_table(countries, names, cols, values,
+                            index_freq=index_freq if is_agg_none else 0,
+                            country_freq=country_freq if is_agg_none else 0,
+                            attributes=describe_columns(cols, by_code)), fetched
+
+    columns, rows = sparse_masks(values, len(countries))
+    cols = [col for col, keep in zip(cols, columns) if keep]
+    results = AggregationMethods.aggregate_values([country for country, keep in zip(countries, rows) if keep],
+                                                  names[rows], cols, values[np.ix_(rows, columns)], agg_method,
+                                                  callback, index_freq=index_freq, country_freq=country_freq,
+                                                  statistics=statistics, attributes=describe_columns(cols, by_code),
+                                                  codes=indicator_codes)
+    return results, fetched
 
 
 class CountryTreeWidgetItem(QTreeWidgetItem):
@@ -137,7 +374,7 @@ class IndicatorTableView(QTableView):
         self.verticalHeader().hide()
 
     def startDrag(self, supported_actions):
-        indices = self.selectionModel().selectedRows()
+        indices = [self.model().index(row, 0) for row in selected_view_rows(self)]
         if indices:
             data = self.model().mimeData(indices)
             if not data:
@@ -155,13 +392,12 @@ class IndicatorTableView(QTableView):
                 default_action = Qt.CopyAction
             res = drag.exec(supported_actions, default_action)
             if res == Qt.MoveAction:
-                selected = self.selectionModel().selectedRows()
-                rows = list(map(QModelIndex.row, selected))
+                selected = [self.model().index(row, 0) for row in selected_view_rows(self)]
+                rows = list(map(QModelIndex.row, source_indexes(selected, self)))
                 model = source_model(self)
                 rows = model.mapToSourceRows(rows)
                 model.resetSorting()
-                for s1, s2 in reversed(list(slices(rows))):
-                    delslice(self.model(), s1, s2)
+                model.remove_rows(rows)
             self.dragDropActionDidComplete.emit(res)
 
     def dropEvent(self, event):
@@ -201,52 +437,158 @@ class IndicatorTableView(QTableView):
         super().keyPressEvent(event)
         self.keyPressed.emit(event.key())
 
-class IndicatorTableModel(PyTableModel):
+def object_array(items: List) -> np.ndarray:
+    """ One dimensional array of objects, tuples are kept as elements.
+    """
+    return np.fromiter(items, dtype=object, count=len(items))
+
+
+class IndicatorTableModel(AbstractSortTableModel):
     """
     A Indicator table item model specialized for Drag and Drop.
+    Indicators are stored in column arrays and rows are addressed by
+    their position in storage, use mapToSourceRows for rows of the model.
     """
     MIME_TYPE = "application/x-Orange-IndicatorTableItemModelData"
+    HEADERS = ['Source', 'Indicator', 'Description']
+
+    # Emitted once per insertion or removal of any number of indicators
+    indicatorsChanged = Signal()
 
-    def __init__(self, *args, placeholder=None, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.placeholder = placeholder
-        self.setHorizontalHeaderLabels(['Source', 'Indicator', 'Description', '', '', ''])
+    def __init__(self, indicators=(), parent=None):
+        super().__init__(parent)
+        self._set_indicators(list(indicators))
 
-    def wrap(self, table):
-        super().wrap(table)
+    @classmethod
+    def _arrays(cls, indicators: List) -> Tuple[np.ndarray, List[np.ndarray]]:
+        """ Array of indicators and arrays of their sources, codes and descriptions.
+        """
+        return (object_array(indicators),
+                [object_array([ind[i] for ind in indicators]) for i in range(len(cls.HEADERS))])
+
+    def _set_indicators(self, indicators: List):
+        self._indicators, self._columns = self._arrays(indicators)
+
+    def wrap(self, indicators: List):
+        self.beginResetModel()
+        self._set_indicators(list(indicators))
+        self.resetSorting()
+        self.endResetModel()
+
+    def tolist(self) -> List:
+        return self._indicators.tolist()
+
+    def __len__(self):
+        return len(self._indicators)
+
+    def __bool__(self):
+        return len(self) != 0
+
+    def __iter__(self):
+        return iter(self._indicators)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._indicators[item].tolist()
+        return self._indicators[item]
+
+    def __delitem__(self, i):
+        self.remove_rows(np.arange(len(self))[i])
+
+    def __setitem__(self, i, value):
+        if not isinstance(i, slice) or i.step not in (None, 1):
+            raise TypeError("Only contiguous slices of indicators can be replaced")
+        start, stop, _ = i.indices(len(self))
+        self.remove_rows(np.arange(start, max(start, stop)))
+        self.insert_rows(start, value)
+
+    def _check_sort_order(self):
+        if self.mapToSourceRows(Ellipsis) is not Ellipsis:
+            raise RuntimeError("Can't modify IndicatorTableModel when it's sorted")
 
-    def setData(self, index, value, role):
-        row = self.mapFromSourceRows(index.row())
-        if role == Qt.EditRole:
-            self[row][index.column()] = value
-            self.dataChanged.emit(index, index)
+    def insert_rows(self, row: int, indicators: List):
+        """ Insert indicators before the row in storage with a single signal.
+        """
+        self._check_sort_order()
+        if not len(indicators):
+            return
+        inserted, inserted_columns = self._arrays(list(indicators))
+        self.beginInsertRows(QModelIndex(), row, row + len(indicators) - 1)
+        self._indicators = np.concatenate((self._indicators[:row], inserted, self._indicators[row:]))
+        self._columns = [np.concatenate((col[:row], new, col[row:]))
+                         for col, new in zip(self._columns, inserted_columns)]
+        self.endInsertRows()
+        self.indicatorsChanged.emit()
+
+    def extend(self, indicators: List):
+        self.insert_rows(len(self), indicators)
+
+    def remove_rows(self, rows):
+        """ Remove rows in storage. Contiguous rows are removed with a single
+        signal and scattered ones with a reset of the model.
+        """
+        self._check_sort_order()
+        rows = np.unique(np.asarray(rows, dtype=int))
+        if not len(rows):
+            return
+        contiguous = rows[-1] - rows[0] + 1 == len(rows)
+        if contiguous:
+            self.beginRemoveRows(QModelIndex(), rows[0], rows[-1])
+        else:
+            self.beginResetModel()
+        keep = np.ones(len(self), dtype=bool)
+        keep[rows] = False
+        self._indicators = self._indicators[keep]
+        self._columns = [col[keep] for col in self._columns]
+        if contiguous:
+            self.endRemoveRows()
         else:
-            self._roleData[row][index.column()][role] = value
+            self.endResetModel()
+        self.indicatorsChanged.emit()
+
+    def removeRows(self, row, count, parent=QModelIndex()):
+        if parent.isValid() or count <= 0:
+            return False
+        self.remove_rows(np.arange(row, row + count))
         return True
 
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and section < len(self.HEADERS):
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def sortColumnData(self, column):
+        return self._columns[column]
+
     def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.mapToSourceRows(index.row())
+        col = index.column()
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self._columns[col][row]
         if role == Qt.ToolTipRole:
-            row = self.mapFromSourceRows(index.row())
-            col = index.column()
             if col == 0:
-                value = self[row][col]
+                value = self._columns[col][row]
                 for (code, tooltip) in DB_NAMES:
                     if code == value:
                         return tooltip
             if col == 1:
-                code = self[row][col]
-                exp = self[row][3]
+                code = self._columns[col][row]
+                exp = self._indicators[row][3]
                 split = code.split(".")
                 tips = []
-                if len(split) != len(exp):
-                    print(split)
-                    print(exp)
                 for i in range(min(len(split), len(exp))):
                     tips.append(f"{split[i]} - {exp[i]}")
                 return "\r\n".join(tips)
             return ""
-        else:
-            return super().data(index, role)
+        return None
 
     def flags(self, index):
         flags = super().flags(index)
@@ -274,7 +616,8 @@ class IndicatorTableModel(PyTableModel):
         For efficiency reasons only the variable instances are set on the
         mime data (under `'_items'` property)
         """
-        items = [self[index.row()] for index in indexlist]
+        rows = self.mapToSourceRows([index.row() for index in indexlist])
+        items = [self._indicators[row] for row in rows]
         mime = QMimeData()
         mime.setData(self.MIME_TYPE, b'')
         mime.setProperty("_items", items)
@@ -294,7 +637,7 @@ class IndicatorTableModel(PyTableModel):
         if row < 0:
             row = self.rowCount()
         self.resetSorting()
-        self[row:row] = indicators
+        self.insert_rows(row, indicators)
 
         return True
 
@@ -306,40 +649,77 @@ class IndicatorFilterProxyModel(QSortFilterProxyModel):
         self.rem_sparse = False
         self.and_filter = False
         self._filter_string = ""
+        self._words = []
+        # Acceptance of indexed indicators keyed by (source, code)
+        self._search_index = None
+        self._accepted = None
+        # Words, mode and matching keys of the last search, refined when a query narrows
+        self._last_search = None
+
+    def set_search_index(self, index: IndicatorSearchIndex):
+        self._search_index = index
+        self._last_search = None
+        self.update_filter()
 
     def set_filter_string(self, filter):
         self._filter_string = str(filter).lower()
-        self.invalidateFilter()
+        self.update_filter()
 
     def set_rel(self, x):
         self.rel_only = x
-        self.invalidateFilter()
+        self.update_filter()
 
     def set_sparse(self, x):
         self.rem_sparse = x
-        self.invalidateFilter()
+        self.update_filter()
 
     def set_and_filter(self):
         self.and_filter = not self.and_filter
-        self.invalidateFilter()
+        self.update_filter()
+
+    def update_filter(self):
+        self._words = self._filter_string.split()
+        index = self._search_index
+        if index is not None:
+            keys = self._search(index)
+            if self.rel_only:
+                keys = keys & index.relative
+            if self.rem_sparse:
+                keys = keys - index.sparse
+            self._accepted = dict.fromkeys(index.haystacks, False)
+            self._accepted.update(dict.fromkeys(keys, True))
+        self.invalidate()
+
+    def _search(self, index: IndicatorSearchIndex) -> Set[Tuple[str, str]]:
+        if not self._words:
+            self._last_search = None
+            return index.haystacks.keys()
+        last = self._last_search
+        # Rechecking previous matches pays off when they are much fewer than the tokens to scan
+        if last is not None and last[1] == self.and_filter and len(last[2]) < len(index.postings) // 10 \
+                and narrows(last[0], self._words, self.and_filter):
+            keys = index.refine(last[2], self._words, self.and_filter)
+        else:
+            keys = index.search(self._words, self.and_filter)
+        self._last_search = (self._words, self.and_filter, keys)
+        return keys
 
     def filter_accepts_row(self, row):
         if len(row) > 0:
             row_str = f"{row[0]} {row[1]} {row[2]}"
             row_str = row_str.lower()
-            filters = self._filter_string.split()
-
             if self.and_filter:
-                return all(f in row_str for f in filters)
-            else:
-                for f in filters:
-                    if f in row_str:
-                        return True
-            return not filters
+                return all(f in row_str for f in self._words)
+            return any(f in row_str for f in self._words) or not self._words
         return False
 
     def filterAcceptsRow(self, source_row, source_parent):
         row = self.sourceModel()[source_row]
+        if self._accepted is not None and len(row) > 0:
+            # Rows of indexed indicators are resolved with a single lookup
+            accepted = self._accepted.get((row[0], row[1]))
+            if accepted is not None:
+                return accepted
         return self.filter_accepts_row(row) and \
                (not self.rel_only or (self.rel_only and row[4])) and \
                (not self.rem_sparse or (self.rem_sparse and not row[6]))
@@ -354,6 +734,7 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
     icon = "icons/socioeconomicindices.svg"
 
     agg_method: int = Setting(AggregationMethods.MEAN)
+    agg_statistics: List = Setting(list(range(len(YearStatistics.ITEMS))))
     indicator_freq: float = Setting(60)
     country_freq: float = Setting(90)
     selected_years: List = Setting([])
@@ -368,27 +749,67 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
     class Outputs:
         world_data = Output("World data", Table)
 
+    class Information(OWWidget.Information):
+        loading_catalog = Msg("Loading countries, years and indicators ...")
+
+    class Warning(OWWidget.Warning):
+        no_statistics = Msg("Select at least one statistic.")
+
+    class Error(OWWidget.Error):
+        catalog_unavailable = Msg("Catalog could not be loaded.\n{}")
+
     def __init__(self):
         OWWidget.__init__(self)
         ConcurrentWidgetMixin.__init__(self)
         super().__init__()
 
         self.world_data = None
-        self.year_features = MONGO_HANDLE.years()
+        # Raw series of the last result reused when the selection changes
+        self.fetched_series = None
+        # Catalog is loaded in the background and fills the controls when ready
+        self.catalog_loaded = False
+        self.pending_inputs = None
+        # Keys of selected available indicators hidden by the Relative/Sparse filters
+        self.hidden_selected_keys = set()
+        self.year_features = []
+        self.country_features = []
+        self.indicator_features = []
+        self.indicators_by_code = {}
+        self.statistic_items = list(YearStatistics.ITEMS)
 
         self._setup_gui()
+        self.resize(1400, 800)
 
-        # Assign values to control views
-        self.year_features = MONGO_HANDLE.years()
-        self.country_features = MONGO_HANDLE.countries()
-        self.indicator_features = MONGO_HANDLE.indicators()
+        self.Information.loading_catalog()
+        self.catalog_executor = ThreadExecutor(self)
+        self.catalog_watcher = FutureWatcher(self.catalog_executor.submit(load_catalog))
+        self.catalog_watcher.done.connect(self.__on_catalog_loaded)
+
+    def __on_catalog_loaded(self, future):
+        self.Information.loading_catalog.clear()
+        try:
+            catalog = future.result()
+        except Exception as ex:
+            self.Error.catalog_unavailable(ex)
+            return
+        self.set_catalog(catalog)
+
+    def set_catalog(self, catalog: Catalog):
+        selected_years = self.selected_years
+        self.year_features = catalog.years
+        self.selected_years = selected_years
+        self.country_features = catalog.countries
+        self.indicator_features = catalog.indicators
+        self.indicators_by_code = catalog.by_code
+        self.available_indices_view.model().set_search_index(catalog.search_index)
+        self.catalog_loaded = True
 
         self.set_country_tree(self.country_features)
 
+        self.select_input_indicators(self.pending_inputs)
+        self.pending_inputs = None
         self.initial_indices_update()
 
-        self.resize(1400, 800)
-
     def _setup_gui(self):
         fbox = gui.widgetBox(self.controlArea, "", orientation=0)
         fbox.setFixedWidth(550)
@@ -418,7 +839,14 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
         grid.addWidget(agg_box, alignment=Qt.AlignLeft)
         agg_box.setFixedWidth(175)
         gui.comboBox(agg_box, self, 'agg_method', items=AggregationMethods.ITEMS,
-                     callback=self.__on_dummy_change)
+                     callback=self.__on_agg_method_changed)
+        self.statistics_list = gui.listBox(
+            agg_box, self, 'agg_statistics', labels='statistic_items',
+            selectionMode=QListView.MultiSelection, callback=self.__on_dummy_change,
+            tooltip="Statistics computed together by the Statistics method."
+        )
+        self.statistics_list.setFixedHeight(4 * self.statistics_list.sizeHintForRow(0) + 6)
+        self.statistics_list.setEnabled(self.agg_method == AggregationMethods.STATISTICS)
 
         self.years_list = gui.listBox(
             sbox, self, 'selected_years', labels='year_features',
@@ -470,31 +898,40 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
         filters_row.layout().addWidget(self.__indicator_sparse_checkbox)
         self.available_box.layout().addWidget(filters_row)
 
+        # Bursts of selection changes, e.g. while filtering, update titles once
+        self.__redraw_timer = QTimer(self, singleShot=True, interval=0)
+        self.__redraw_timer.timeout.connect(self.fix_redraw)
+
+        # Changes of both panes in a single move are committed once
+        self.__indicators_commit_timer = QTimer(self, singleShot=True, interval=0)
+        self.__indicators_commit_timer.timeout.connect(self.__on_dummy_change)
+
         def dropcompleted(action):
             if action == Qt.MoveAction:
                 self.fix_redraw()
-                self.commit.deferred()
+                self.__indicators_commit_timer.start()
 
         self.available_indices_model = IndicatorTableModel()
         self.available_indices_view = IndicatorTableView()
         proxy = IndicatorFilterProxyModel()
         proxy.setFilterKeyColumn(-1)
         proxy.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
-        self.__indicator_filter_line_edit.textChanged.connect(proxy.set_filter_string)
-        self.__indicator_filter_line_edit.textChanged.connect(self.fix_redraw)
+        # Bursts of typing are applied as a single filter change
+        self.__filter_timer = QTimer(self, singleShot=True, interval=FILTER_DELAY)
+        self.__filter_timer.timeout.connect(self.__on_filter_text_changed)
+        self.__indicator_filter_line_edit.textChanged.connect(lambda: self.__filter_timer.start())
         self.available_indices_view.setModel(proxy)
         self.available_indices_view.model().setSourceModel(self.available_indices_model)
         self.available_indices_view.dragDropActionDidComplete.connect(dropcompleted)
-        self.available_indices_view.selectionModel().selectionChanged.connect(self.fix_redraw)
+        self.available_indices_view.selectionModel().selectionChanged.connect(self.__redraw_timer.start)
         self.available_box.layout().addWidget(self.available_indices_view)
 
         self.selected_indices_model = IndicatorTableModel()
         self.selected_indices_view = IndicatorTableView()
         self.selected_indices_view.setModel(self.selected_indices_model)
-        self.selected_indices_view.selectionModel().selectionChanged.connect(self.fix_redraw)
+        self.selected_indices_view.selectionModel().selectionChanged.connect(self.__redraw_timer.start)
 
-        self.selected_indices_model.rowsInserted.connect(self.__on_dummy_change)
-        self.selected_indices_model.rowsRemoved.connect(self.__on_dummy_change)
+        self.selected_indices_model.indicatorsChanged.connect(self.__indicators_commit_timer.start)
         self.selected_indices_view.dragDropActionDidComplete.connect(dropcompleted)
         self.selected_indices_view.keyPressed.connect(self.__on_indicator_delete)
         self.selected_box.layout().addWidget(self.selected_indices_view)
@@ -521,16 +958,17 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
         self.available_box.setTitle(f'Available Indicators     '
                                     f'{self.available_indices_view.model().rowCount()} / '
                                     f'{self.available_indices_model.rowCount()} displayed | '
-                                    f'{int(len(self.available_indices_view.selectedIndexes())/3)} chosen')
+                                    f'{len(selected_view_rows(self.available_indices_view))} chosen')
         self.selected_box.setTitle(f'Selected Indicators     '
                                    f'{self.selected_indices_view.model().rowCount()} displayed | '
-                                   f'{int(len(self.selected_indices_view.selectedIndexes())/3)} chosen')
+                                   f'{len(selected_view_rows(self.selected_indices_view))} chosen')
 
     def initial_indices_update(self):
         used = self.selected_indicators
-        self.available_indices_model[:] = [index for index in self.indicator_features
-                                           if index not in used]
-        self.selected_indices_model[:] = self.selected_indicators
+        self.hidden_selected_keys = set()
+        self.available_indices_model.wrap([index for index in self.indicator_features
+                                           if index not in used])
+        self.selected_indices_model.wrap(self.selected_indicators)
 
         self.selected_years = self.selected_years if len(self.selected_years) > 0 else list(range(10))
         self.fix_redraw()
@@ -541,17 +979,27 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
 
         self.commit.deferred()
 
+    def __on_filter_text_changed(self):
+        self.available_indices_view.model().set_filter_string(self.__indicator_filter_line_edit.text())
+        self.fix_redraw()
+
     def __on_indicator_filter_changed(self):
+        selected = self._selected_indicator_keys()
+        # Selection is rebuilt after filtering, Qt would otherwise adjust it row by row
+        self.available_indices_view.clearSelection()
         model = self.available_indices_view.model()
         model.set_and_filter()
         self.__indicator_and_button.setText("All" if model.and_filter else "Any")
-        self._select_indicator_rows()
+        self._select_indicator_rows(selected)
 
     def __on_indicator_relative_changed(self):
+        selected = self._selected_indicator_keys()
+        # Selection is rebuilt after filtering, Qt would otherwise adjust it row by row
+        self.available_indices_view.clearSelection()
         model = self.available_indices_view.model()
         model.set_rel(self.__indicator_relative_checkbox.isChecked())
         model.set_sparse(self.__indicator_sparse_checkbox.isChecked())
-        self._select_indicator_rows()
+        self._select_indicator_rows(selected)
 
     def __on_indicator_delete(self, key):
         if key == Qt.Key_Delete or key == Qt.Key_Backspace:
@@ -565,9 +1013,7 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
                 col = self.selected_indices_view.horizontalHeader().sortIndicatorSection()
 
                 src_model.resetSorting()
-
-                for s1, s2 in reversed(list(slices(unsorted_rows))):
-                    delslice(src_model, s1, s2)
+                src_model.remove_rows(unsorted_rows)
 
                 if col <= 2:
                     self.selected_indices_view.sortByColumn(col, order)
@@ -575,21 +1021,24 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
                 dst_model = source_model(self.available_indices_view)
                 dst_model.extend(indics)
 
-                self.commit.deferred()
-
                 self.fix_redraw()
 
     def __on_dummy_change(self):
         self.commit.deferred()
 
+    def __on_agg_method_changed(self):
+        self.statistics_list.setEnabled(self.agg_method == AggregationMethods.STATISTICS)
+        self.commit.deferred()
+
     def on_exception(self, ex: Exception):
         raise ex
 
     def on_done(self, result: Any):
+        result, self.fetched_series = result
         self.Outputs.world_data.send(result)
 
     def on_partial_result(self, result: Any) -> None:
-        pass
+        self.Outputs.world_data.send(result)
 
     def copy_to_clipboard(self):
         self.copyRow()
@@ -604,26 +1053,42 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
 
     @Inputs.indicators
     def set_inputs(self, inputs: Optional[Table]):
+        if not self.catalog_loaded:
+            self.pending_inputs = inputs
+            return
+        if self.select_input_indicators(inputs):
+            self.initial_indices_update()
+
+    def select_input_indicators(self, inputs: Optional[Table]) -> bool:
         if inputs is not None and inputs.domain is not None:
             input_indicators = []
             for col in inputs.domain:
                 if isinstance(col, ContinuousVariable) and not re.match(r'\d+-.*', col.name):
-                    indicator = [ind for ind in self.indicator_features if ind[1] == col.name]
-                    if indicator:
-                        input_indicators.extend(indicator)
+                    input_indicators.extend(self.indicators_by_code.get(col.name, []))
             if 0 < len(input_indicators):
                 self.selected_indicators = input_indicators
-                self.initial_indices_update()
+                return True
+        return False
 
     @gui.deferred
     def commit(self):
+        # Settings are committed once the catalog is loaded
+        if not self.catalog_loaded:
+            return
         years = []
         for i in self.selected_years:
             years.append(int(self.year_features[i]))
         self.selected_indicators = self.selected_indices_model.tolist()
+        # Statistics without any selected statistic have no columns
+        self.Warning.no_statistics(shown=self.agg_method == AggregationMethods.STATISTICS and not self.agg_statistics)
+        if self.Warning.no_statistics.is_shown() and len(years) > 1:
+            self.cancel()
+            self.Outputs.world_data.send(None)
+            return
         self.start(
             run, list(self.selected_countries), self.selected_indicators,
-            years, self.agg_method, self.indicator_freq, self.country_freq
+            years, self.agg_method, sorted(self.agg_statistics), self.indicator_freq, self.country_freq,
+            self.fetched_series
         )
 
     def country_checked(self, item, column):
@@ -689,28 +1154,46 @@ class OWWHStudy(OWWidget, ConcurrentWidgetMixin):
                     wrapper.setCheckState(0, state)
                     org_node.addChild(wrapper)
 
-    def _select_indicator_rows(self):
+    def _selected_indicator_keys(self) -> Set[Tuple[str, str]]:
         model = source_model(self.available_indices_view)
-        available_selected = [model[r] for r in self.selected_rows(self.available_indices_view)]
-        n_rows, n_columns = model.rowCount(), model.columnCount()
+        selected = {indicator_key(model[r]) for r in self.selected_rows(self.available_indices_view)}
+        return selected | self.hidden_selected_keys
+
+    def _select_indicator_rows(self, keys: Set[Tuple[str, str]]):
+        """ Select rows of available indicators with given keys, contiguous rows
+        are selected as a single range.
+        """
+        view = self.available_indices_view
+        proxy, model = view.model(), source_model(view)
+        n_columns = proxy.columnCount()
+        n_rows = proxy.rowCount()
         selection = QItemSelection()
-        for i in range(n_rows):
-            indicator = model.data(model.index(i, 1))
-            if indicator in available_selected:
-                _selection = QItemSelection(model.index(i, 0),
-                                            model.index(i, n_columns - 1))
-                selection.merge(_selection, QItemSelectionModel.Select)
-
-        self.available_indices_view.selectionModel().select(
-            selection, QItemSelectionModel.ClearAndSelect
-        )
+        shown = set()
+        start = None
+        for row in range(n_rows + 1):
+            selected = False
+            if row < n_rows:
+                key = indicator_key(model[proxy.mapToSource(proxy.index(row, 0)).row()])
+                if key in keys:
+                    selected = True
+                    shown.add(key)
+            if selected and start is None:
+                start = row
+            elif not selected and start is not None:
+                selection.select(proxy.index(start, 0), proxy.index(row - 1, n_columns - 1))
+                start = None
+
+        view.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect)
+        # Selected rows hidden by the filter are selected again when they are shown
+        self.hidden_selected_keys = keys - shown
+        self.fix_redraw()
 
     @staticmethod
     def selected_rows(view):
         """ Return the selected rows in the view.
         """
-        rows = view.selectionModel().selectedRows()
         model = view.model()
+        rows = [model.index(row, 0) for row in selected_view_rows(view)]
         if isinstance(model, QSortFilterProxyModel):
             rows = [model.mapToSource(r) for r in rows]
         return [r.row() for r in rows]
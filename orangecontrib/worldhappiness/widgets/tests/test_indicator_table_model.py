@@ -0,0 +1,116 @@
+import unittest
+
+import numpy as np
+from AnyQt.QtCore import Qt
+
+from Orange.widgets.tests.base import GuiTest
+
+from orangecontrib.worldhappiness.widgets.owwhstudy import IndicatorTableModel
+
+N_INDICATORS = 50000
+
+
+def catalog(n):
+    """ Synthetic catalog of indicators (db, code, desc, code_exp, is_relative, url, sparse). """
+    sources = ["WDI", "WHR", "HSL_OECD"]
+    return [(sources[i % 3], f"IND.{i % 97}.{i}", f"Description {n - i:06d}", ["Topic", "Subject"], False, "", False)
+            for i in range(n)]
+
+
+class TestIndicatorTableModel(GuiTest):
+    def setUp(self):
+        self.indicators = catalog(N_INDICATORS)
+        self.model = IndicatorTableModel(self.indicators)
+        self.signals = []
+        self.model.rowsInserted.connect(lambda _, first, last: self.signals.append(("inserted", first, last)))
+        self.model.rowsRemoved.connect(lambda _, first, last: self.signals.append(("removed", first, last)))
+        self.model.modelReset.connect(lambda: self.signals.append(("reset",)))
+        self.model.indicatorsChanged.connect(lambda: self.signals.append(("changed",)))
+
+    def codes(self):
+        return [self.model.data(self.model.index(row, 1)) for row in range(self.model.rowCount())]
+
+    def test_data(self):
+        model = self.model
+        self.assertEqual(model.rowCount(), N_INDICATORS)
+        self.assertEqual(model.columnCount(), 3)
+        self.assertEqual(model.data(model.index(5, 1)), "IND.5.5")
+        self.assertEqual(model.data(model.index(5, 2)), f"Description {N_INDICATORS - 5:06d}")
+        self.assertEqual(model.data(model.index(4, 0), Qt.ToolTipRole), "World Happiness Report")
+        self.assertEqual(model.data(model.index(5, 1), Qt.ToolTipRole), "IND - Topic\r\n5 - Subject")
+        self.assertEqual(model.tolist(), self.indicators)
+
+    def test_insert_rows(self):
+        inserted = catalog(3)
+        self.model.insert_rows(10, inserted)
+        self.assertEqual(self.signals, [("inserted", 10, 12), ("changed",)])
+        self.assertEqual(self.model.tolist(), self.indicators[:10] + inserted + self.indicators[10:])
+        self.assertEqual(self.codes()[9:14], ["IND.9.9", "IND.0.0", "IND.1.1", "IND.2.2", "IND.10.10"])
+
+        self.signals.clear()
+        self.model.insert_rows(0, [])
+        self.model.extend(inserted[:1])
+        self.assertEqual(self.signals, [("inserted", N_INDICATORS + 3, N_INDICATORS + 3), ("changed",)])
+
+    def test_remove_contiguous_rows(self):
+        self.model.remove_rows(np.arange(100, 30100))
+        self.assertEqual(self.signals, [("removed", 100, 30099), ("changed",)])
+        self.assertEqual(self.model.tolist(), self.indicators[:100] + self.indicators[30100:])
+
+    def test_remove_scattered_rows(self):
+        rows = np.arange(0, N_INDICATORS, 2)
+        self.model.remove_rows(rows[::-1])
+        self.assertEqual(self.signals, [("reset",), ("changed",)])
+        self.assertEqual(self.model.tolist(), self.indicators[1::2])
+        self.assertEqual(self.codes()[:2], ["IND.1.1", "IND.3.3"])
+
+        self.signals.clear()
+        self.model.remove_rows([])
+        self.assertEqual(self.signals, [])
+
+    def test_sort(self):
+        model = self.model
+        model.sort(2, Qt.AscendingOrder)
+        rows = model.mapToSourceRows(np.arange(N_INDICATORS))
+        np.testing.assert_equal(rows, np.arange(N_INDICATORS)[::-1])
+        self.assertEqual(model.data(model.index(0, 2)), "Description 000001")
+        self.assertEqual(model.data(model.index(0, 1), Qt.ToolTipRole),
+                         f"IND - Topic\r\n{(N_INDICATORS - 1) % 97} - Subject")
+
+        model.sort(1, Qt.DescendingOrder)
+        codes = self.codes()
+        self.assertEqual(codes, sorted(codes, reverse=True))
+
+        # Storage is modified only when the model is not sorted
+        with self.assertRaises(RuntimeError):
+            model.insert_rows(0, catalog(1))
+        model.resetSorting()
+        self.assertEqual(self.codes()[:2], ["IND.0.0", "IND.1.1"])
+
+    def test_mime_data(self):
+        model = self.model
+        model.sort(2, Qt.AscendingOrder)
+        mime = model.mimeData([model.index(0, 0), model.index(1, 0)])
+        self.assertTrue(mime.hasFormat(IndicatorTableModel.MIME_TYPE))
+        items = mime.property("_items")
+        self.assertEqual(items, [self.indicators[-1], self.indicators[-2]])
+
+        target = IndicatorTableModel(catalog(2))
+        self.assertTrue(target.dropMimeData(mime, Qt.MoveAction, 1, 0, None))
+        self.assertEqual(target.tolist(), [catalog(2)[0], self.indicators[-1], self.indicators[-2], catalog(2)[1]])
+        self.assertTrue(target.dropMimeData(mime, Qt.MoveAction, -1, 0, None))
+        self.assertEqual(target.tolist()[-2:], items)
+
+    def test_move_between_models(self):
+        # Bulk move as done between panes of the widget
+        selected = IndicatorTableModel()
+        rows = np.arange(1000, 21000)
+        selected.extend(self.model[1000:21000])
+        del self.model[1000:21000]
+        self.assertEqual(len(self.model), N_INDICATORS - len(rows))
+        self.assertEqual(selected.tolist(), self.indicators[1000:21000])
+        self.assertEqual(self.signals, [("removed", 1000, 20999), ("changed",)])
+
+
+if __name__ == "__main__":
+    unittest.main()
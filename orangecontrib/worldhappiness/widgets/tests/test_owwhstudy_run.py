@@ -0,0 +1,152 @@
+import random
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from orangecontrib.worldhappiness.whstudy import AggregationMethods, YearStatistics
+from orangecontrib.worldhappiness.whstudy.world_data_api import WorldIndicators
+from orangecontrib.worldhappiness.widgets import owwhstudy
+
+YEARS = [2010, 2011, 2012]
+# Last two indicators have no values in any country
+CODES = [f"IND.{i}.X" for i in range(8)]
+EMPTY = CODES[6:]
+
+
+class State:
+    def set_progress_value(self, value):
+        pass
+
+    def set_status(self, status):
+        pass
+
+    def is_interruption_requested(self):
+        return False
+
+    def set_partial_result(self, result):
+        pass
+
+
+def make_db():
+    db = mongomock.MongoClient()["world-database"]
+    for c in range(12):
+        indicators = {code.replace(".", "_"): {str(y): float(c * 10 + i + y - 2010) for y in YEARS}
+                      for i, code in enumerate(CODES) if code not in EMPTY}
+        db.countries.insert_one({"_id": f"C{c:02d}", "name": f"Country {c}", "indicators": indicators})
+    return db
+
+
+def make_sparse_db(seed=0):
+    """ Countries miss indicators and years, some have values only outside of queried years. """
+    rnd = random.Random(seed)
+    db = mongomock.MongoClient()["world-database"]
+    for c in range(20):
+        indicators = {}
+        for code in CODES:
+            if code in EMPTY or rnd.random() < 0.2:
+                continue
+            first = rnd.choice([2000, 2008, 2011, 2013])
+            years = [y for y in range(first, 2016) if rnd.random() < 0.6]
+            if years:
+                indicators[code.replace(".", "_")] = {str(y): round(rnd.uniform(-10, 10), 2) for y in years}
+        db.countries.insert_one({"_id": f"C{c:02d}", "name": f"Country {c}", "indicators": indicators})
+    return db
+
+
+class MockIndicators(WorldIndicators):
+    def __init__(self, db, server_version):
+        super().__init__("user", "password", disk_cache=False, memory_cache_size=0)
+        self.mock_db = db
+        self.server_version_cache = server_version
+
+    def get_connection(self):
+        return self.mock_db
+
+
+class RunTest(unittest.TestCase):
+    """ Runs the widget's query on a mock database, aggregated by the database or locally. """
+    countries = []
+
+    def setUp(self):
+        self.db = None
+        self.indicators = [("WDI", code, f"Description of {code}", [], False, "", False) for code in CODES]
+
+    def run_widget(self, agg_method, index_freq, country_freq, server=True, countries=None, years=YEARS):
+        handle = MockIndicators(self.db, (8, 0) if server else (0, 0))
+        statistics = list(range(len(YearStatistics.ITEMS)))
+        with patch.object(owwhstudy, "_MONGO_HANDLE", handle):
+            table, _ = owwhstudy.run(countries or self.countries, self.indicators, years, agg_method, statistics,
+                                     index_freq, country_freq, None, State())
+        return table
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class TestRun(RunTest):
+    countries = [f"C{c:02d}" for c in range(12)]
+
+    def setUp(self):
+        super().setUp()
+        self.db = make_db()
+
+    def test_empty_indicators_do_not_count(self):
+        # Country threshold counts only indicators with values, as data of years omits empty ones
+        for server in (True, False):
+            for agg_method in (AggregationMethods.MEAN, AggregationMethods.MEDIAN, AggregationMethods.MIN,
+                               AggregationMethods.MAX):
+                if server and agg_method == AggregationMethods.MEDIAN:
+                    # mongomock does not implement $sortArray
+                    continue
+                table = self.run_widget(agg_method, 60, 90, server)
+                self.assertEqual(table.X.shape, (12, 6), (server, agg_method))
+            table = self.run_widget(AggregationMethods.STATISTICS, 60, 90, server)
+            self.assertEqual(table.X.shape, (12, 24), server)
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class TestServerAggregation(RunTest):
+    """ Aggregates computed by the database equal aggregates of downloaded series. """
+    countries = [f"C{c:02d}" for c in range(20)] + ["XXX"]
+
+    def setUp(self):
+        super().setUp()
+        self.db = make_sparse_db()
+
+    def assertTablesEqual(self, server, local, msg):
+        if local is None:
+            self.assertIsNone(server, msg)
+            return
+        self.assertEqual([v.name for v in server.domain.variables + server.domain.metas],
+                         [v.name for v in local.domain.variables + local.domain.metas], msg)
+        np.testing.assert_allclose(server.X, local.X, err_msg=str(msg))
+        np.testing.assert_equal(server.metas, local.metas, err_msg=str(msg))
+
+    def test_server_equals_local(self):
+        # Median is not compared, mongomock does not implement $sortArray
+        for years in ([2010, 2011, 2012], [2014, 2013, 2012, 2011, 2010], [2030, 2031], [2001, 2002]):
+            for agg_method in (AggregationMethods.MEAN, AggregationMethods.MIN, AggregationMethods.MAX):
+                for index_freq, country_freq in ((0, 0), (50, 0), (0, 50), (60, 90), (100, 100)):
+                    msg = years, agg_method, index_freq, country_freq
+                    server = self.run_widget(agg_method, index_freq, country_freq, True, years=years)
+                    local = self.run_widget(agg_method, index_freq, country_freq, False, years=years)
+                    self.assertTablesEqual(server, local, msg)
+
+    def test_last_stored_value(self):
+        # Series without values in queried years aggregate to their last stored value
+        self.db.countries.insert_one({"_id": "LAST", "name": "Last", "indicators": {
+            "IND_0_X": {"2001": 1.0, "2003": 5.0}, "IND_1_X": {"2011": 2.0, "2012": 4.0}}})
+        for server in (True, False):
+            for agg_method, expected in ((AggregationMethods.MEAN, [5, 3]), (AggregationMethods.MIN, [5, 2]),
+                                         (AggregationMethods.MAX, [5, 4])):
+                table = self.run_widget(agg_method, 0, 0, server, countries=["LAST"], years=[2010, 2011, 2012])
+                self.assertEqual([v.name for v in table.domain.attributes], CODES[:2])
+                np.testing.assert_equal(table.X, [expected], str((server, agg_method)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -46,7 +46,7 @@ DATA_FILES = [
 INSTALL_REQUIRES = [
     'Orange3>=3.31',
     'pandas',
-    'pymongo',
+    'pymongo>=4.2',
     'wbgapi',
     'dnspython'
 ]